@@ -0,0 +1,242 @@
+#!/usr/bin/python
+from collections import OrderedDict
+from operator import itemgetter
+from time import time
+import logging
+import re
+import threading
+
+import psycopg2
+from psycopg2.extras import execute_values
+from sqlalchemy import exc
+from sqlalchemy.util import LRUCache
+
+from finalysis.db_registry import gen_upsert
+
+BATCH = 500
+LINGER = 100
+STATCOLS = ('rows', 'collapsed', 'flushes', 'full', 'lingered', 'errors',
+            'max_batch', 'max_ms')
+BIND = re.compile(r'%\(([^)]+)\)s')
+UNSPLITTABLE = (exc.CompileError, exc.OperationalError, exc.InterfaceError,
+                psycopg2.OperationalError, psycopg2.InterfaceError)
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+class BatchWriter():
+    '''Buffers rows per table and upserts them in batches
+
+    A table's rows are written once batch of them are waiting or the
+    first has waited linger milliseconds. All writes happen on one
+    flusher thread, in the order the rows arrived, so callers never wait
+    on the db. Each batch is one transaction with one executemany per set
+    of columns the rows carry. A conflicting row updates only the columns
+    it was sent with, or is dropped if update is False. Rows repeating a
+    primary key within a batch are collapsed to the last one, or the
+    first without update, as a single upsert may not touch a row twice.
+    Rows given as tuples skip sqlalchemy's parameter handling and go to
+    psycopg2's execute_values as they are.
+
+    If a batch fails, each set of columns is written on its own, and a
+    failing set is split in halves until the rows that fail are found
+    alone, so only those are dropped and counted as errors. A lost
+    connection or a statement that cannot compile fails every row alike,
+    so the rows it hits are dropped without splitting.
+
+    batch       -- the rows per table that trigger a flush
+    linger      -- the longest a row waits to be written, in ms
+    update      -- update conflicting rows rather than dropping new ones
+    '''
+    def __init__(self, batch=BATCH, linger=LINGER, update=True):
+        self.batch = batch
+        self.linger = linger/1000.0
+        self.update = update
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pending = dict()
+        self.statements = dict()
+        self.compiled = LRUCache(1000)
+        self.stats = dict([(s, 0) for s in STATCOLS])
+        self.stopped = False
+        self.flusher = threading.Thread(target=self.run)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def add(self, engine, table, row, columns=None):
+        '''Queue row for table in engine's db
+
+        row         -- a dict of column values, or a tuple of the values
+                       of columns
+        columns     -- the column names of a tuple row
+        '''
+        key = (str(engine.url), table.fullname)
+        if columns is not None:
+            if engine.dialect.driver == 'psycopg2': row = (columns, row)
+            else: row = dict(zip(columns, row))
+        with self.lock:
+            if key not in self.pending:
+                self.pending[key] = (engine, table, time(), [])
+            rows = self.pending[key][3]
+            rows.append(row)
+            if len(rows) >= self.batch: self.wake.set()
+
+    def due(self, final=False):
+        '''Remove and return the buffers ready to write, and the seconds
+        until the next one is'''
+        now = time()
+        ready = []
+        wait = self.linger
+        with self.lock:
+            for key, entry in self.pending.items():
+                started, rows = entry[2], entry[3]
+                if len(rows) >= self.batch:
+                    ready.append((key, entry, 'full'))
+                elif final or now - started >= self.linger:
+                    ready.append((key, entry, 'lingered'))
+                else:
+                    wait = min(wait, started + self.linger - now)
+                    continue
+                del self.pending[key]
+        ready.sort(key=lambda r: r[1][2])
+        return ready, wait
+
+    def run(self):
+        while not self.stopped:
+            self.wake.clear()
+            ready, wait = self.due()
+            for key, entry, reason in ready: self.write(key, entry, reason)
+            if not ready: self.wake.wait(wait)
+
+    def close(self):
+        '''Stop the flusher and write everything still buffered'''
+        self.stopped = True
+        self.wake.set()
+        self.flusher.join()
+        for key, entry, reason in self.due(final=True)[0]:
+            self.write(key, entry, reason)
+
+    def statement(self, key, engine, table, columns):
+        skey = key + (columns,)
+        if skey not in self.statements:
+            self.statements[skey] = gen_upsert(engine, table, self.update,
+                                               columns)
+        return self.statements[skey]
+
+    def values_statement(self, key, engine, table, columns):
+        '''The upsert for tuple rows of columns, as the sql and VALUES
+        template execute_values takes, and the getter that puts a row's
+        values in the order of the template, or None if they are'''
+        skey = key + (columns, 'values')
+        if skey not in self.statements:
+            stmt = self.statement(key, engine, table, tuple(sorted(columns)))
+            compiled = stmt.compile(dialect=engine.dialect,
+                                    column_keys=list(columns))
+            values = '(%s)' % compiled.insert_single_values_expr
+            order = [columns.index(b) for b in BIND.findall(values)]
+            getter = None
+            if order != range(len(columns)): getter = itemgetter(*order)
+            self.statements[skey] = (str(compiled).replace(values, '%s'),
+                                     BIND.sub('%s', values), getter)
+        return self.statements[skey]
+
+    def group(self, table, rows):
+        '''Split rows by the columns they carry, one row per primary key
+
+        The groups are keyed by the columns and whether the rows are
+        tuples.
+        '''
+        pkey = [c.name for c in table.primary_key]
+        positions = dict()
+        groups = OrderedDict()
+        for row in rows:
+            if isinstance(row, dict):
+                group = (tuple(sorted(row)), False)
+                pk = tuple([row.get(k) for k in pkey])
+            else:
+                columns, row = row
+                if columns not in positions:
+                    positions[columns] = [columns.index(k) for k in pkey]
+                group = (columns, True)
+                pk = tuple([row[i] for i in positions[columns]])
+            byrow = groups.setdefault(group, dict())
+            if self.update or pk not in byrow: byrow[pk] = row
+        return groups
+
+    def write(self, key, entry, reason):
+        engine, table, started, rows = entry
+        start = time()
+        groups = [(group, byrow.values())
+                  for group, byrow in self.group(table, rows).items()]
+        written = sum([len(grouped) for group, grouped in groups])
+        self.stats['collapsed'] += len(rows) - written
+        try:
+            self.execute(key, engine, table, groups)
+        except Exception as err:
+            logger.warn('Writing %i rows to %s failed, retrying in parts: '
+                        '%s', len(rows), table.fullname, err)
+            if len(groups) > 1: err = None
+            failed = sum([self.write_part(key, engine, table, group,
+                                          grouped, err)
+                          for group, grouped in groups])
+            self.stats['errors'] += failed
+            written -= failed
+        ms = (time() - start)*1000
+        self.stats['rows'] += written
+        self.stats['flushes'] += 1
+        self.stats[reason] += 1
+        self.stats['max_batch'] = max(self.stats['max_batch'], len(rows))
+        self.stats['max_ms'] = max(self.stats['max_ms'], int(ms))
+        logger.debug('Flushed %i rows to %s in %0.1f ms (%s)', len(rows),
+                     table.fullname, ms, reason)
+
+    def write_part(self, key, engine, table, group, rows, err=None):
+        '''Write the rows of one group, splitting them in halves on
+        failure, and return how many were dropped
+
+        err         -- the error the rows already failed with, if they did
+        '''
+        if err is None:
+            try:
+                self.execute(key, engine, table, [(group, rows)])
+                return 0
+            except Exception as part_err:
+                err = part_err
+        if len(rows) == 1 or isinstance(err, UNSPLITTABLE):
+            logger.error('Dropped %i rows for %s: %s', len(rows),
+                         table.fullname, err)
+            return len(rows)
+        half = len(rows)/2
+        return (self.write_part(key, engine, table, group, rows[:half]) +
+                self.write_part(key, engine, table, group, rows[half:]))
+
+    def execute(self, key, engine, table, groups):
+        '''Write (group, rows) pairs in one transaction'''
+        conn = engine.connect().execution_options(
+                   compiled_cache=self.compiled)
+        try:
+            with conn.begin():
+                for (columns, tuples), rows in groups:
+                    if tuples:
+                        self.write_values(conn, key, engine, table, columns,
+                                          rows)
+                    else:
+                        conn.execute(self.statement(key, engine, table,
+                                                    columns), rows)
+        finally:
+            conn.close()
+
+    def write_values(self, conn, key, engine, table, columns, rows):
+        sql, template, getter = self.values_statement(key, engine, table,
+                                                      columns)
+        if getter is not None: rows = map(getter, rows)
+        cursor = conn.connection.cursor()
+        try:
+            execute_values(cursor, sql, rows, template=template,
+                           page_size=len(rows))
+        finally:
+            cursor.close()
+
+    def report(self):
+        '''The flush statistics as one line of name=value pairs'''
+        return ', '.join(['%s=%i' % (s, self.stats[s]) for s in STATCOLS])
@@ -0,0 +1,152 @@
+#!/usr/bin/python
+from datetime import datetime, timedelta
+import argparse
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+from finalysis.data_collection import parse_option_chain as poc
+from finalysis.db_registry import BACKENDS
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'example.xml')
+FIELDS = ['CallLast', 'CallChange', 'CallBid', 'CallAsk', 'CallVol',
+          'CallOpen', 'Date', 'StrikePrice', 'PutLast', 'PutChange', 'PutBid',
+          'PutAsk', 'PutVol', 'PutOpen']
+STAGES = ['connect', 'parse', 'ticker', 'underlying', 'cids', 'prices',
+          'pairs', 'contracts', 'total']
+PERCENTILES = [50, 90, 99]
+
+def load_template(example=EXAMPLE):
+    '''Split example.xml into the text before the option rows, a row
+    template with one %(field)s per FIELDS entry, and the closing text'''
+    text = open(example).read()
+    start = text.index('<tr id="OptionChains1_rptOptions_ctl00_trOption"')
+    end = text.index('</tr>', start) + len('</tr>')
+    head, row, tail = text[:start], text[start:end], text[end:]
+    tail = tail[tail.index('</tbody>'):]
+    row = row.replace('%', '%%')
+    for field in FIELDS:
+        row = re.sub('(lbl%s"[^>]*>)[^<]*' % field, r'\1%%(%s)s' % field, row)
+    return head, row, tail
+
+def gen_chain_file(filename, template, ticker, timestamp, strikes, expiries,
+                   stock=87.24):
+    '''Write a chain file in example.xml format
+
+    filename    -- the file to write
+    template    -- the output of load_template()
+    ticker      -- the ticker written at the top of the file
+    timestamp   -- the datetime of the data
+    strikes     -- the number of strikes per expiry
+    expiries    -- the number of monthly expiries
+    stock       -- the underlying price the option prices are built around
+    '''
+    head, row, tail = template
+    lines = head.split('\n')
+    lines[0] = ticker
+    head = '\n'.join(lines)
+    head = re.sub(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d',
+                  timestamp.strftime('%Y-%m-%dT%H:%M:%S'), head, count=1)
+    first = timestamp.year*12 + timestamp.month - 1
+    labels = [datetime(m/12, m%12 + 1, 1).strftime('%b-%y')
+              for m in range(first, first + expiries)]
+    f = open(filename, 'w')
+    f.write(head)
+    for e, label in enumerate(labels):
+        for k in range(strikes):
+            strike = round(stock) - strikes/2 + k
+            tv = 0.25 + 0.1*e
+            call = max(stock - strike, 0) + tv
+            put = max(strike - stock, 0) + tv
+            f.write(row % {'CallLast': '%0.2f' % call, 'CallChange': '0.00',
+                           'CallBid': '%0.2f' % (call - 0.05),
+                           'CallAsk': '%0.2f' % (call + 0.05),
+                           'CallVol': '%i' % (k*10),
+                           'CallOpen': '%i' % (k*100),
+                           'Date': label,
+                           'StrikePrice': '%0.3f' % strike,
+                           'PutLast': '%0.2f' % put, 'PutChange': '0.00',
+                           'PutBid': '%0.2f' % (put - 0.05),
+                           'PutAsk': '%0.2f' % (put + 0.05),
+                           'PutVol': '%i' % (k*10),
+                           'PutOpen': '%i' % (k*100)})
+    f.write(tail)
+    f.close()
+
+def report(timings, rows, seconds):
+    print '%-10s %6s' % ('stage', 'n') + \
+          ''.join([' %9s' % ('p%i ms' % p) for p in PERCENTILES]) + \
+          ' %9s' % 'max ms'
+    for stage in STAGES:
+        t = np.array(timings.get(stage, []))*1000
+        if not len(t): continue
+        pcts = [np.percentile(t, p) for p in PERCENTILES]
+        print '%-10s %6i' % (stage, len(t)) + \
+              ''.join([' %9.1f' % pct for pct in pcts]) + ' %9.1f' % t.max()
+    print '%i rows in %0.3f s, %0.1f rows/s' % (rows, seconds, rows/seconds)
+    print 'Peak RSS %0.1f MiB' % \
+          (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0)
+
+if __name__ == '__main__':
+    description = 'Benchmark ChainParser ingestion stage by stage.'
+
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument('db_name', type=str)
+    p.add_argument('--db_host', type=str, default='',
+                   help='user:password@host:port, as used by sqlalchemy')
+    p.add_argument('--backend', type=str, default='postgresql', 
+                   choices=BACKENDS, 
+                   help='Default is postgresql. For sqlite db_name is a file')
+    p.add_argument('--strikes', type=int, default=100,
+                   help='Strikes per expiry. Default is 100')
+    p.add_argument('--expiries', type=int, default=10,
+                   help='Default is 10')
+    p.add_argument('--files', type=int, default=20,
+                   help='Number of chain files to ingest. Default is 20')
+    p.add_argument('--ticker', type=str, default='BENCH',
+                   help='Default is BENCH')
+    p.add_argument('--soup', action='store_true',
+                   help='Parse with BeautifulSoup instead of streaming')
+    p.add_argument('--keep', type=str,
+                   help='Write the chain files to this directory and keep them')
+    args = p.parse_args()
+
+    if args.keep:
+        filedir = args.keep
+        if not os.path.isdir(filedir): os.makedirs(filedir)
+    else: filedir = tempfile.mkdtemp()
+    template = load_template()
+    start_ts = datetime.now().replace(microsecond=0)
+    filenames = []
+    for n in range(args.files):
+        timestamp = start_ts + timedelta(seconds=n)
+        filename = os.path.join(filedir, '%s_%s.html'
+                                % (args.ticker, timestamp.isoformat()))
+        gen_chain_file(filename, template, args.ticker, timestamp,
+                       args.strikes, args.expiries)
+        filenames.append(filename)
+    print >> sys.stderr, 'Generated %i files of %i rows in %s' \
+                         % (args.files, 2*args.strikes*args.expiries, filedir)
+
+    timings = dict()
+    rows = 0
+    seconds = 0
+    for filename in filenames:
+        start = datetime.now()
+        cp = poc.ChainParser(filename, args.db_name, args.db_host,
+                             streaming=not args.soup, backend=args.backend)
+        total = (datetime.now() - start).total_seconds()
+        cp.timings['total'] = total
+        for stage, t in cp.timings.items():
+            timings.setdefault(stage, []).append(t)
+        rows += cp.inserted + cp.skipped
+        seconds += total
+    report(timings, rows, seconds)
+
+    if not args.keep: shutil.rmtree(filedir)
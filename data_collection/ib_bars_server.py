@@ -5,29 +5,57 @@ __copyright__ = "(C) 2013 gazzman GNU GPL 3."
 __contributors__ = []
 from datetime import datetime
 import SocketServer
+import _strptime # strptime imports it lazily, which is not thread safe
+import argparse
 import logging
 import signal
 import sys
 import threading
 
 from pytz import timezone
-from sqlalchemy import create_engine, MetaData
-from sqlalchemy.schema import CreateSchema
+from sqlalchemy import MetaData
 from sqlalchemy.exc import IntegrityError, ProgrammingError
 
+from finalysis.data_collection import batch_writer, record_stream
+from finalysis.data_collection.batch_writer import (BATCH, LINGER, 
+                                                   BatchWriter)
+from finalysis.data_collection.packed_rows import PackedSchema, parse_fields
+from finalysis.data_collection.record_stream import RecordStreamHandler
+from finalysis.db_registry import ensure_tables, gen_dburl, get_engine
 from finalysis.bar_orms import gen_table
 
 LOGLEVEL = logging.INFO
 PKEY = ['symbol', 'timestamp']
 
 
-class ForkedTCPServer(SocketServer.ForkingMixIn, SocketServer.TCPServer):
-    pass
-
-class ForkedTCPRequestHandler(SocketServer.BaseRequestHandler):
-    def handle(self):
+# Serializes table creation across the handler threads
+setup_lock = threading.Lock()
+
+# The engine and Table for each (db, schema, tablename)
+tables = dict()
+
+def get_table(db_name, schema, tablename):
+    '''Return the db's pooled engine and the table, created the first
+    time this process sees it'''
+    key = (db_name, schema, tablename)
+    with setup_lock:
+        if key not in tables:
+            engine = get_engine(gen_dburl(db_name), executemany_mode='values')
+            table = gen_table(tablename, MetaData(), schema=schema)
+            try: ensure_tables(engine, table.metadata, schema)
+            except (ProgrammingError, IntegrityError) as err: 
+                logger.error(err)
+            tables[key] = (engine, table)
+    return tables[key]
+
+class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+class ThreadedTCPRequestHandler(RecordStreamHandler):
+    def process(self, message):
         # Parse message
-        message = self.request.recv(1024).strip()
+        message = message.strip()
         logger.debug('Message received')
         data = [x.strip() for x in message.split(',')]
         db_name, schema, tablename = data[0:3]
@@ -57,37 +85,23 @@ class ForkedTCPRequestHandler(SocketServer.BaseRequestHandler):
         key = ['%s=%s' % (k, v) for k, v in row.items() if k in PKEY]
         logger.debug('Data is %s', row)
 
-        # Connect to db
-        logger.debug('Connecting to db %s', db_name)
-        dburl = 'postgresql+psycopg2:///%s' % (db_name)
-        engine = create_engine(dburl)
-        conn = engine.connect()
-        logger.debug('Connected to db %s', db_name)
-
-        # Create schema and table if necessary
-        try: engine.execute(CreateSchema(schema))
-        except ProgrammingError: pass
-        metadata = MetaData(engine)
-        table = gen_table(tablename, metadata, schema=schema)
-        try: metadata.create_all()
-        except (ProgrammingError, IntegrityError) as err: logger.error(err)
-
-        # Insert or update row in table
-        try:
-            conn.execute(table.insert(), **row)
-            logger.debug('Inserted %s', row)
-        except IntegrityError as err:
-            if 'duplicate key' in str(err):
-                data = dict([(k, v) for k, v in row.items() if k not in PKEY])
-                upd = table.update(values=data)\
-                           .where(table.c.symbol==row['symbol'])\
-                           .where(table.c.timestamp==row['timestamp'])
-                conn.execute(upd)
-                logger.debug('Updated %s with %s', key, data)
-            else: raise(err)
-        conn.close()
-        logger.debug('Closed connection to db %s', db_name)
-        logger.info('Wrote data in %s.%s for %s', schema, tablename, key)
+        # Get the cached engine and table
+        engine, table = get_table(db_name, schema, tablename)
+
+        # Queue the row for the next batched upsert
+        writer.add(engine, table, row)
+        logger.info('Queued data in %s.%s for %s', schema, tablename, key)
+        return True
+
+    def define(self, message):
+        data = [x.strip() for x in message.split(',')]
+        db_name, schema, tablename = data[0:3]
+        constants, packed = parse_fields(data[3:])
+        if 'timestamp' in constants:
+            date, time = constants['timestamp'].split()
+            constants['timestamp'] = add_timezone(date, time)
+        engine, table = get_table(db_name, schema, tablename)
+        return PackedSchema(engine, table, constants, packed)
 
 def add_timezone(date, time, locale='US/Eastern', fmt='%Y%m%d %H:%M:%S'):
     tz = timezone(locale)
@@ -98,12 +112,26 @@ def add_timezone(date, time, locale='US/Eastern', fmt='%Y%m%d %H:%M:%S'):
 
 def cleanup(signal, frame):
     server.server_close()
+    writer.close()
+    logger.warn('Flushes: %s', writer.report())
     logger.warn('BAR2DB server shutdown')
     sys.exit(0)
 
 if __name__ == '__main__':
-    HOST = sys.argv[1]
-    PORT = int(sys.argv[2])
+    description = 'Write the rows sent over TCP to postgresql in batches.'
+
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument('host', type=str)
+    p.add_argument('port', type=int)
+    p.add_argument('--batch', type=int, default=BATCH,
+                   help='Rows per table that trigger a write. Default is %i'
+                        % BATCH)
+    p.add_argument('--linger', type=int, default=LINGER,
+                   help='Most ms a row waits to be written. Default is %i'
+                        % LINGER)
+    args = p.parse_args()
+    HOST = args.host
+    PORT = args.port
 
     # Initialize logging
     logger_fmt = ' '.join(['%(levelno)s, [%(asctime)s #%(process)5i]',
@@ -115,8 +143,13 @@ if __name__ == '__main__':
     logger.addHandler(hdlr)
     logger.setLevel(LOGLEVEL)
 
-    # Start the server
-    server = ForkedTCPServer((HOST, PORT), ForkedTCPRequestHandler)
+    # Start the writer and the server
+    writer = BatchWriter(args.batch, args.linger, update=True)
+    for module in (batch_writer, record_stream):
+        logging.getLogger(module.__name__).addHandler(hdlr)
+        logging.getLogger(module.__name__).setLevel(LOGLEVEL)
+    server = ThreadedTCPServer((HOST, PORT), ThreadedTCPRequestHandler)
+    server.writer = writer
     logger.warn('BAR2DB server started. Listeing on socket %s:%i', HOST, PORT)
     logger.info('Format messages as "db_name, schema, tablename, bar"')
     signal.signal(signal.SIGTERM, cleanup)
@@ -5,57 +5,77 @@ __copyright__ = "(C) 2013 gazzman GNU GPL 3."
 __contributors__ = []
 from datetime import datetime
 import SocketServer
+import _strptime # strptime imports it lazily, which is not thread safe
+import argparse
 import logging
 import signal
 import sys
 import threading
 
 from pytz import timezone
-from sqlalchemy import create_engine, MetaData
-from sqlalchemy.schema import CreateSchema
-from sqlalchemy.exc import IntegrityError, ProgrammingError
+from sqlalchemy import MetaData
 
+from finalysis.data_collection import batch_writer, record_stream
+from finalysis.data_collection.batch_writer import (BATCH, LINGER, 
+                                                   BatchWriter)
+from finalysis.data_collection.packed_rows import PackedSchema, parse_fields
+from finalysis.data_collection.record_stream import RecordStreamHandler
+from finalysis.db_registry import ensure_tables, gen_dburl, get_engine
 from finalysis.butter_dense_orms import *
 
 LOGLEVEL = logging.INFO
 
-class ForkedTCPServer(SocketServer.ForkingMixIn, SocketServer.TCPServer):
-    pass
+# Serializes table creation across the handler threads
+setup_lock = threading.Lock()
 
-class ForkedTCPRequestHandler(SocketServer.BaseRequestHandler):
-    def handle(self):
+# The engine and Table for each (db, schema, tablename)
+tables = dict()
+
+def get_table(db_name, schema, tablename):
+    '''Return the db's pooled engine and the table, created the first
+    time this process sees it'''
+    key = (db_name, schema, tablename)
+    with setup_lock:
+        if key not in tables:
+            engine = get_engine(gen_dburl(db_name), executemany_mode='values')
+            table = gen_table(tablename, MetaData(), schema=schema)
+            ensure_tables(engine, table.metadata, schema)
+            tables[key] = (engine, table)
+    return tables[key]
+
+class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+class ThreadedTCPRequestHandler(RecordStreamHandler):
+    def process(self, message):
         # Parse message
         logger.debug('Message received')
-        message = self.request.recv(1024).strip()
+        message = message.strip()
         data = [x.strip() for x in message.split(',')]
         db_name, schema, tablename = data[0], data[1], data[2]
         row = dict([x.split('=') for x in data[3:] if 'None' not in x])
         row['timestamp'] = add_timezone(*row['timestamp'].split())
         
-        # Connect to db
-        logger.debug('Connecting to db %s', db_name)
-        dburl = 'postgresql+psycopg2:///%s' % (db_name)
-        engine = create_engine(dburl)
-        conn = engine.connect()
-        logger.debug('Connected to db %s', db_name)
-
-        # Create schema and table if necessary
-        try: engine.execute(CreateSchema(schema))
-        except ProgrammingError: pass
-        metadata = MetaData(engine)
-        table = gen_table(tablename, metadata, schema=schema)
-        metadata.create_all()
-
-        # Insert row into table
-        try:
-            conn.execute(table.insert(), **row)
-        except IntegrityError as err:
-            if 'duplicate key' in str(err): pass
-            else: raise(err)
-        conn.close()
-        logger.info('Wrote BD row in %s.%s for %s at %s', schema, tablename, 
-                                                          row['underlying'],
-                                                          row['timestamp'])
+        # Get the cached engine and table
+        engine, table = get_table(db_name, schema, tablename)
+
+        # Queue the row for the next batched insert
+        writer.add(engine, table, row)
+        logger.info('Queued BD row in %s.%s for %s at %s', schema, tablename, 
+                                                           row['underlying'],
+                                                           row['timestamp'])
+        return True
+
+    def define(self, message):
+        data = [x.strip() for x in message.split(',')]
+        db_name, schema, tablename = data[0], data[1], data[2]
+        constants, packed = parse_fields(data[3:])
+        if 'timestamp' in constants:
+            constants['timestamp'] = add_timezone(
+                                         *constants['timestamp'].split())
+        engine, table = get_table(db_name, schema, tablename)
+        return PackedSchema(engine, table, constants, packed)
 
 def add_timezone(date, time, locale='US/Eastern', fmt='%Y%m%d %H:%M:%S'):
     tz = timezone(locale)
@@ -66,12 +86,26 @@ def add_timezone(date, time, locale='US/Eastern', fmt='%Y%m%d %H:%M:%S'):
 
 def cleanup(signal, frame):
     server.server_close()
+    writer.close()
+    logger.warn('Flushes: %s', writer.report())
     logger.warn('BD2DB server shutdown')
     sys.exit(0)
 
 if __name__ == '__main__':
-    HOST = sys.argv[1]
-    PORT = int(sys.argv[2])
+    description = 'Write the rows sent over TCP to postgresql in batches.'
+
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument('host', type=str)
+    p.add_argument('port', type=int)
+    p.add_argument('--batch', type=int, default=BATCH,
+                   help='Rows per table that trigger a write. Default is %i'
+                        % BATCH)
+    p.add_argument('--linger', type=int, default=LINGER,
+                   help='Most ms a row waits to be written. Default is %i'
+                        % LINGER)
+    args = p.parse_args()
+    HOST = args.host
+    PORT = args.port
 
     # Initialize logging
     logger_fmt = ' '.join(['%(levelno)s, [%(asctime)s #%(process)5i]',
@@ -83,8 +117,13 @@ if __name__ == '__main__':
     logger.addHandler(hdlr)
     logger.setLevel(LOGLEVEL)
 
-    # Start the server
-    server = ForkedTCPServer((HOST, PORT), ForkedTCPRequestHandler)
+    # Start the writer and the server
+    writer = BatchWriter(args.batch, args.linger, update=False)
+    for module in (batch_writer, record_stream):
+        logging.getLogger(module.__name__).addHandler(hdlr)
+        logging.getLogger(module.__name__).setLevel(LOGLEVEL)
+    server = ThreadedTCPServer((HOST, PORT), ThreadedTCPRequestHandler)
+    server.writer = writer
     logger.warn('BD2DB server started. Listeing on socket %s:%i', HOST, PORT)
     logger.info('Format messages as "db_name, schema, tablename, datarow"')
     signal.signal(signal.SIGTERM, cleanup)
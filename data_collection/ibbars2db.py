@@ -10,38 +10,26 @@ import re
 import sys
 
 from pytz import timezone
-from sqlalchemy import create_engine, MetaData, Table
+from sqlalchemy import MetaData, Table
 from sqlalchemy import Boolean, Column, DateTime
-from sqlalchemy.schema import CreateSchema
-from sqlalchemy.exc import IntegrityError, ProgrammingError
 from sqlalchemy.dialects.postgresql import NUMERIC, VARCHAR
 
-def add_timezone(date, time, locale='US/Eastern', fmt='%Y%m%d %H:%M:%S'):
-    tz = timezone(locale)
-    dt = ' '.join([date, time])
-    dt = datetime.strptime(dt, fmt)
-    tzone = tz.tzname(dt)
-    return ' '.join([dt.date().isoformat(), dt.time().isoformat(), tzone])
+from finalysis.db_registry import (BACKENDS, ensure_tables, gen_dburl, 
+                                   gen_upsert, get_engine)
 
-def parse_barline(line):
+def localize(date, time, locale='US/Eastern', fmt='%Y%m%d %H:%M:%S'):
+    dt = datetime.strptime(' '.join([date, time]), fmt)
+    return timezone(locale).localize(dt)
+
+def parse_bar(line, symbol):
+    '''Parse a bar line into a row of typed values for a bulk insert'''
     line_list = line.split()
     (date, time), bar = line_list[4:6], line_list[6:]
-    timestamp = add_timezone(date, time)
-    bar = dict([x.split('=') for x in bar])
-    return timestamp, bar
-
-def bar_to_db(conn, table, symbol, timestamp, bar):
-    try:
-        conn.execute(table.insert(), ticker=symbol, timestamp=timestamp, **bar)
-        logger.debug('Inserted %s', **bar)
-    except IntegrityError as err:
-        if 'duplicate key' in str(err):
-            upd = table.update(values=bar)\
-                       .where(table.c.ticker==symbol)\
-                       .where(table.c.timestamp==timestamp)
-            conn.execute(upd)
-            logger.info('Updated %s, %s with %s', symbol, timestamp, data)
-        else: raise(err)
+    row = dict([x.split('=') for x in bar])
+    row['hasgaps'] = row['hasgaps'] == 'true'
+    row['ticker'] = symbol
+    row['timestamp'] = localize(date, time)
+    return row
 
 def gen_table(tablename, metadata, schema=None):
     table = Table(tablename, metadata,
@@ -78,33 +66,33 @@ if __name__ == "__main__":
     p.add_argument('database', help=db_help)
     p.add_argument('--schema', help=schema_help)
     p.add_argument('--host', default='', help=host_help)
+    p.add_argument('--backend', default='postgresql', choices=BACKENDS,
+                   help='the db backend. For sqlite database is a file')
     p.add_argument('-v', '--version', action='version', 
                    version='%(prog)s ' + __version__)
     args = p.parse_args()
     datafile, tablename, symbol = parse_fname_list(args.datafile)
 
     # Establish connection to db
-    dburl = 'postgresql+psycopg2://%s/%s' % (args.host, args.database)
-    engine = create_engine(dburl)
-    conn = engine.connect()
-    print >> sys.stderr, "Connected to db %s" % args.database
+    engine = get_engine(gen_dburl(args.database, args.host, args.backend))
 
     # Create schema and table if necessary
-    if args.schema:
-        try: engine.execute(CreateSchema(args.schema))
-        except ProgrammingError: pass
-    metadata = MetaData(engine)
+    metadata = MetaData()
     table = gen_table(tablename, metadata, schema=args.schema)
-    metadata.create_all()
+    ensure_tables(engine, metadata, schema=args.schema)
+    conn = engine.connect()
+    print >> sys.stderr, "Connected to db %s" % args.database
     print >> sys.stderr, "Preparing to write to table %s.%s" % (args.schema,
                                                                 tablename)
 
-    # Write data to db
+    # Write data to db in one upsert
+    rows = []
     with open(datafile, 'r') as f:
         for line in f:
             try:
-                timestamp, bar = parse_barline(line.lower())
-                bar_to_db(conn, table, symbol, timestamp, bar)
-            except ValueError:
+                rows.append(parse_bar(line.lower(), symbol))
+            except (ValueError, KeyError):
                 pass
-    print >> sys.stderr, "Data written."
+    if rows: conn.execute(gen_upsert(engine, table), rows)
+    conn.close()
+    print >> sys.stderr, "%i bars written." % len(rows)
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+from datetime import datetime
+from multiprocessing import Pool, cpu_count
+import argparse
+import glob
+import os
+import sys
+
+from finalysis.data_collection import parse_option_chain as poc
+from finalysis.db_registry import (BACKENDS, ensure_tables, gen_dburl,
+                                   get_engine)
+
+engine = None
+
+def init_worker(db_name, db_host, backend):
+    '''Give the worker process the one connection it parses files with'''
+    global engine
+    engine = get_engine(gen_dburl(db_name, db_host, backend))
+
+def ingest(job):
+    filename, db_name, db_host, streaming, force = job
+    start = datetime.now()
+    try:
+        cp = poc.ChainParser(filename, db_name, db_host, streaming=streaming,
+                             engine=engine, force=force)
+    except Exception as err:
+        poc.logger.error('Failed to ingest %s: %s' % (filename, err))
+        return filename, 0, 0, None
+    end = datetime.now()
+    return (filename, cp.inserted + cp.skipped, cp.inserted, 
+            cp.seconds_elapsed(start, end))
+
+def gen_filelist(paths):
+    '''Expand directories and globs, largest file first'''
+    files = set()
+    for path in paths:
+        if os.path.isdir(path): path = os.path.join(path, '*')
+        files.update([f for f in glob.glob(path) if os.path.isfile(f)])
+    return sorted(files, key=os.path.getsize, reverse=True)
+
+if __name__ == '__main__':
+    description = 'Parse a batch of option chain files into a db in parallel.'
+
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument('db_name', type=str)
+    p.add_argument('paths', type=str, nargs='+', 
+                   help='chain files, directories or quoted globs')
+    p.add_argument('--db_host', type=str, default='',
+                   help='user:password@host:port, as used by sqlalchemy')
+    p.add_argument('--backend', type=str, default='postgresql', 
+                   choices=BACKENDS, 
+                   help='Default is postgresql. For sqlite db_name is a file')
+    p.add_argument('--processes', type=int, default=cpu_count(),
+                   help='Default is the number of cpus, %i' % cpu_count())
+    p.add_argument('--soup', action='store_true',
+                   help='Parse with BeautifulSoup instead of streaming')
+    p.add_argument('--force', action='store_true',
+                   help='Ingest files already in the ingest manifest')
+    args = p.parse_args()
+
+    files = gen_filelist(args.paths)
+    if not files: sys.exit('No files found')
+
+    # Create the tables once, before the workers start
+    ensure_tables(get_engine(gen_dburl(args.db_name, args.db_host, 
+                                       args.backend)),
+                  poc.Base.metadata)
+
+    jobs = [(f, args.db_name, args.db_host, not args.soup, args.force) 
+            for f in files]
+    pool = Pool(args.processes, init_worker, 
+                (args.db_name, args.db_host, args.backend))
+    start = datetime.now()
+    done = 0
+    rows = 0
+    inserted = 0
+    failed = 0
+    for filename, f_rows, f_inserted, seconds in pool.imap_unordered(ingest,
+                                                                     jobs):
+        if seconds is None: failed += 1
+        else:
+            done += 1
+            rows += f_rows
+            inserted += f_inserted
+            print '%s: %i rows, %i new, %0.3f s' % (filename, f_rows, 
+                                                    f_inserted, seconds)
+    pool.close()
+    pool.join()
+    elapsed = (datetime.now() - start).total_seconds()
+    print 'Ingested %i files (%i failed), %i rows (%i new) in %0.3f s' \
+          % (done, failed, rows, inserted, elapsed)
+    if elapsed:
+        print '%0.2f files/s, %0.1f rows/s' % (done/elapsed, rows/elapsed)
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+from datetime import date, datetime
+import struct
+
+from pytz import utc
+from sqlalchemy.types import Boolean, Date, DateTime, Integer, Numeric
+
+DEFINE = 'S'
+ROW = 'R'
+HEAD = struct.Struct('!cH')
+CODES = {'?': '?', 'i': 'i', 'q': 'q', 'f': 'f', 'd': 'd', 'T': 'd', 'D': 'i'}
+NUMBERS = 'iqfd'
+
+def to_timestamp(seconds):
+    return datetime.fromtimestamp(seconds, utc)
+
+def to_date(yyyymmdd):
+    return date(yyyymmdd/10000, yyyymmdd/100 % 100, yyyymmdd % 100)
+
+CONVERT = {'T': to_timestamp, 'D': to_date}
+
+def gen_struct(codes):
+    '''The struct for packed values with the type codes in codes
+
+    ? is a boolean, i and q 4 and 8-byte ints, f and d 4 and 8-byte
+    floats, T a timestamp as seconds since the epoch in a d, and D a date
+    as yyyymmdd in an i. Values are big-endian.
+    '''
+    try: return struct.Struct('!' + ''.join([CODES[c] for c in codes]))
+    except KeyError as err: raise ValueError('unknown type code %s' % err)
+
+def parse_fields(fields):
+    '''Split the column fields of a schema definition
+
+    Returns a dict of the column=value fields, the values every row
+    shares, and a list of (column, code) for the column:code fields,
+    whose values are packed in each row in that order.
+    '''
+    constants = dict()
+    packed = []
+    for field in fields:
+        if '=' in field:
+            name, value = field.split('=', 1)
+            if 'None' not in value: constants[name.strip()] = value.strip()
+        elif ':' in field:
+            name, code = field.split(':', 1)
+            packed.append((name.strip(), code.strip()))
+        else:
+            raise ValueError('bad field %r' % field)
+    return constants, packed
+
+def accepts(column, code):
+    '''Whether column can take values packed with code'''
+    if isinstance(column.type, Boolean): return code == '?'
+    if isinstance(column.type, DateTime): return code == 'T'
+    if isinstance(column.type, Date): return code == 'D'
+    if isinstance(column.type, (Integer, Numeric)): return code in NUMBERS
+    return False
+
+class PackedSchema():
+    '''The layout of the packed rows a client defined for a table
+
+    A row decodes to a tuple of the packed values followed by the
+    constants, in the order of columns. A NaN float is taken as a NULL.
+    Text columns can only be constants.
+
+    engine      -- the engine of the table's db
+    table       -- the sqlalchemy Table the rows go to
+    constants   -- a dict of the column values every row shares
+    packed      -- (column, code) for each packed value, in order
+    '''
+    def __init__(self, engine, table, constants, packed):
+        for name, code in packed:
+            if name not in table.c:
+                raise ValueError('%s has no column %s' % (table.fullname,
+                                                          name))
+            if code not in CODES or not accepts(table.c[name], code):
+                raise ValueError('%s cannot be packed as %r' % (name, code))
+        names = [name for name, code in packed] + constants.keys()
+        if len(set(names)) < len(names):
+            raise ValueError('a column is given twice')
+        missing = [c.name for c in table.primary_key if c.name not in names]
+        if missing:
+            raise ValueError('%s not in schema' % ', '.join(missing))
+        self.engine = engine
+        self.table = table
+        self.columns = tuple(names)
+        self.constants = tuple(constants.values())
+        self.struct = gen_struct([code for name, code in packed])
+        self.size = HEAD.size + self.struct.size
+        self.floats = any([code in 'fdT' for name, code in packed])
+        self.converters = [(i, CONVERT[code])
+                           for i, (name, code) in enumerate(packed)
+                           if code in CONVERT]
+
+    def decode(self, record):
+        '''The parameter tuple of a packed row record'''
+        if len(record) != self.size:
+            raise ValueError('row of %i bytes, expected %i' % (len(record),
+                                                               self.size))
+        values = self.struct.unpack_from(record, HEAD.size)
+        if self.floats and any([v != v for v in values]):
+            values = [None if v != v else v for v in values]
+        if self.converters:
+            values = list(values)
+            for i, convert in self.converters:
+                if values[i] is not None: values[i] = convert(values[i])
+        return tuple(values) + self.constants
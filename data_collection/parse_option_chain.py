@@ -1,19 +1,28 @@
 #!/usr/bin/python
-from calendar import Calendar
+from cStringIO import StringIO
 from datetime import datetime
-from datetime import timedelta as td
+from decimal import Decimal
+from HTMLParser import HTMLParser
 from logging.handlers import TimedRotatingFileHandler
+import hashlib
 import logging
+import re
 import sys
 
 from BeautifulSoup import BeautifulSoup
-from sqlalchemy import create_engine
-from sqlalchemy import Column, ForeignKey, Time
+import numpy as np
+from pytz import FixedOffset
+from sqlalchemy import Column, ForeignKey, Index, Time, UniqueConstraint
+from sqlalchemy import DateTime, func
 from sqlalchemy.orm import backref, relationship, sessionmaker
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.postgresql import (BOOLEAN, CHAR, DATE, INTEGER, 
-                                            NUMERIC, VARCHAR)
+                                            NUMERIC, VARCHAR, insert)
+
+from finalysis.db_registry import (ensure_tables, gen_dburl, get_engine,
+                                   is_sqlite)
+from finalysis.expiry_calendar import get_calendar
 
 #    logger_format = ('%(levelno)s, [%(asctime)s #%(process)d]'
 #                     + '%(levelname)6s -- %(threadName)s: %(message)s')
@@ -26,6 +35,16 @@ hdlr.setFormatter(fmt)
 logger.addHandler(hdlr)
 logger.setLevel(logging.INFO)
 
+CHUNKSIZE = 64*1024
+PRICECOLS = ('id', 'date', 'time', 'last', 'netchg', 'bid', 'ask', 'vol',
+             'openint')
+PRICEFMT = '%i\t%s\t%s\t%.3f\t%.3f\t%.3f\t%.3f\t%i\t%i\n'
+PAIRCOLS = ('ticker', 'date', 'time', 'expiry', 'strike', 'days_to_expiry',
+            'stock_bid', 'stock_ask', 'call_id', 'put_id', 'call_bid',
+            'call_ask', 'put_bid', 'put_ask')
+PAIRFMT = ('%s\t%s\t%s\t%s\t%.3f\t%i\t%s\t%s\t%i\t%i\t'
+           '%.3f\t%.3f\t%.3f\t%.3f\n')
+
 Base = declarative_base()
 
 class Ticker(Base):
@@ -57,6 +76,9 @@ class UnderlyingPrice(Base):
 
 class OptionContract(Base):
     __tablename__ = 'option_contracts'
+    __table_args__ = (UniqueConstraint('ticker', 'expiry', 'call_put', 
+                                       'strike', 
+                                       name='option_contracts_contract_key'),)
     id = Column(INTEGER, primary_key=True)
     ticker = Column(VARCHAR(6), 
                     ForeignKey('tickers.ticker', onupdate='cascade'),
@@ -80,27 +102,205 @@ class OptionPrice(Base):
     vol = Column(INTEGER)
     openint = Column(INTEGER)
 
+class OptionPair(Base):
+    '''The call and put at one expiry and strike, with the stock quote
+
+    One row per snapshot, expiry and strike, written at ingest so PCP
+    queries read a single table instead of joining the price tables.
+    '''
+    __tablename__ = 'option_pairs'
+    ticker = Column(VARCHAR(6), primary_key=True)
+    date = Column(DATE, primary_key=True)
+    time = Column(Time(timezone=True), primary_key=True)
+    expiry = Column(DATE, primary_key=True)
+    strike = Column(NUMERIC(8,3), primary_key=True)
+    days_to_expiry = Column(INTEGER, index=True)
+    stock_bid = Column(NUMERIC(8,3))
+    stock_ask = Column(NUMERIC(8,3))
+    call_id = Column(INTEGER)
+    put_id = Column(INTEGER)
+    call_bid = Column(NUMERIC(8,3))
+    call_ask = Column(NUMERIC(8,3))
+    put_bid = Column(NUMERIC(8,3))
+    put_ask = Column(NUMERIC(8,3))
+    __table_args__ = (Index('option_pairs_snapshot_days', 'ticker', 'date', 
+                            'time', 'days_to_expiry'),)
+
+class IngestManifest(Base):
+    __tablename__ = 'ingest_manifest'
+    sha1 = Column(CHAR(40), primary_key=True)
+    ticker = Column(VARCHAR(6), primary_key=True)
+    date = Column(DATE, primary_key=True)
+    time = Column(Time(timezone=True), primary_key=True)
+    filename = Column(VARCHAR)
+    inserted = Column(INTEGER)
+    skipped = Column(INTEGER)
+    ingested = Column(DateTime(timezone=True), server_default=func.now())
+    __table_args__ = (Index('ingest_manifest_snapshot', 'ticker', 'date', 
+                            'time'),)
+
+def parse_time(timestr):
+    '''Turn a HH:MM:SS[+-HH:MM] string into a datetime.time'''
+    parts = re.split('([+-])', timestr)
+    t = datetime.strptime(parts[0], '%H:%M:%S').time()
+    if len(parts) == 3:
+        hours, minutes = parts[2].split(':')
+        offset = int(hours)*60 + int(minutes)
+        if parts[1] == '-': offset = -offset
+        t = t.replace(tzinfo=FixedOffset(offset))
+    return t
+
+def to_floats(cells):
+    '''Convert an array of numeric strings to floats, blanks become nan'''
+    cells = np.char.strip(np.asarray(cells))
+    cells[cells == ''] = 'nan'
+    return cells.astype(float)
+
+class ChainSnapshot():
+    '''A columnar view of one parsed option chain
+
+    Row i of every array describes the call and put at expiry[i] and
+    strike[i]. The call_* and put_* arrays are named after the chain's
+    lower-cased headers (last, netchg, bid, ask, vol, openint) and hold
+    nan where the file had no value.
+
+    ticker      -- the underlying ticker
+    date        -- the datetime.date of the data
+    time        -- the time of the data as in the file, with its utc offset
+    underlying  -- a dict of the underlying_prices columns, as strings
+    expiry      -- a datetime64[D] array of expiry dates
+    strike      -- a float array of strikes
+    calls       -- a dict of header to float array for the calls
+    puts        -- a dict of header to float array for the puts
+    '''
+    def __init__(self, ticker, date, time, underlying, expiry, strike, calls,
+                 puts):
+        self.ticker = ticker
+        self.date = date
+        self.time = time
+        self.underlying = underlying
+        self.stock_bid = float(underlying['bid'])
+        self.stock_ask = float(underlying['ask'])
+        self.expiry = expiry
+        self.strike = strike
+        self.headers = sorted(calls.keys())
+        for h in self.headers:
+            setattr(self, 'call_%s' % h, calls[h])
+            setattr(self, 'put_%s' % h, puts[h])
+
+    def __len__(self):
+        return len(self.strike)
+
+    def side(self, call_put):
+        prefix = {'C': 'call', 'P': 'put'}[call_put]
+        return dict([(h, getattr(self, '%s_%s' % (prefix, h))) 
+                     for h in self.headers])
+
+    def complete(self, call_put):
+        '''Boolean mask of the rows with every field present'''
+        mask = np.ones(len(self), dtype=bool)
+        for col in self.side(call_put).values(): mask &= ~np.isnan(col)
+        return mask
+
+    def days_to_expiry(self):
+        return (self.expiry - np.datetime64(self.date, 'D')).astype(int)
+
+class TableStreamParser(HTMLParser):
+    '''Collect the th and td text of every tbody as the file is fed in
+
+    Text is gathered the way BeautifulSoup's .text does it: each text node
+    is stripped and the nodes within a cell are joined without a separator.
+    Only the cell strings are kept, never a document tree.
+    '''
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.tbodies = []
+        self.cell = None
+        self.strings = []
+        self.buf = []
+
+    def flush_text(self):
+        if self.cell and self.buf:
+            self.strings.append(''.join(self.buf).strip())
+        self.buf = []
+
+    def handle_starttag(self, tag, attrs):
+        self.flush_text()
+        if tag == 'tbody': self.tbodies.append(([], []))
+        elif tag in ('th', 'td') and self.tbodies:
+            self.cell = tag
+            self.strings = []
+
+    def handle_startendtag(self, tag, attrs):
+        self.flush_text()
+
+    def handle_endtag(self, tag):
+        self.flush_text()
+        if self.cell and tag == self.cell:
+            headers, data = self.tbodies[-1]
+            if tag == 'th': headers.append(''.join(self.strings))
+            else: data.append(''.join(self.strings))
+            self.cell = None
+
+    def handle_data(self, data):
+        if self.cell: self.buf.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data('&%s;' % name)
+
+    def handle_charref(self, name):
+        self.handle_data('&#%s;' % name)
+
 class ChainParser():
-    def __init__(self, filename, dbname, dbhost=''):
-        self.init_db_connection(dbname, dbhost)
+    def __init__(self, filename, dbname, dbhost='', streaming=False, 
+                 engine=None, force=False, backend='postgresql', 
+                 defer_store=False):
+        self.streaming = streaming
+        self.timings = dict()
+        self.inserted = 0
+        self.skipped = 0
+        self.snapshot = None
+        self.filename = filename
+        self.init_db_connection(dbname, dbhost, engine, backend)
+        self.duplicate = self.in_manifest(filename)
+        if self.duplicate and not force:
+            self.session.close()
+            logger.info('Skipped %s, already ingested' % filename)
+            return
         self.parse_data(filename)
-        self.dt_date = datetime.strptime(self.date, '%Y-%m-%d').date()
-        up_key = (self.ticker, self.date, self.time)
+        if not defer_store: self.store()
+
+    def store(self):
+        '''Write the parsed snapshot to the db and close the session
+
+        __init__ calls this unless defer_store is given, in which case the
+        caller can use the snapshot first and store it afterwards, from
+        another thread if need be.
+        '''
+        up_key = (self.ticker, self.dt_date, self.dt_time)
         if not self.session.query(Ticker).get(self.ticker):
             self.add_ticker_to_db()
         if not self.session.query(UnderlyingPrice).get(up_key):
             self.add_up_to_db()
         self.add_contracts_to_db()
+        self.add_to_manifest(self.filename)
         self.session.close()
         logger.info('Session closed')
 
-    def init_db_connection(self, dbname, dbhost):
+    def init_db_connection(self, dbname, dbhost, engine=None, 
+                           backend='postgresql'):
         logger.info('Connecting to db %s...' % dbname)
-        dburl = 'postgresql+psycopg2://%s/%s' % (dbhost, dbname)
-        self.engine = create_engine(dburl)
-        Base.metadata.create_all(self.engine)
+        start = datetime.now()
+
+        self.engine = engine or get_engine(gen_dburl(dbname, dbhost, backend))
+        self.sqlite = is_sqlite(self.engine)
+        ensure_tables(self.engine, Base.metadata)
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
+        self.calendar = get_calendar(self.engine)
+
+        end = datetime.now()
+        self.timings['connect'] = self.seconds_elapsed(start, end)
         logger.info('Connected to db %s' % dbname)
 
     def parse_data(self, filename):
@@ -108,6 +308,28 @@ class ChainParser():
         start = datetime.now()
 
         f = open(filename, 'r')
+        line = self.read_header(f)
+        if self.streaming: underlying, options = self.stream_tables(f, line)
+        else: underlying, options = self.soup_tables(f, line)
+        f.close()
+        self.underlying_headers, self.underlying_data = underlying
+        contract_headers = [th.lower() for th in options[0]]
+        self.call_head = contract_headers[1:7]
+        self.put_head = contract_headers[9:-1]
+        self.num_headers = len(contract_headers)
+        self.snapshot = self.gen_snapshot(options[1])
+        self.num_contracts = 2*len(self.snapshot)
+
+        end = datetime.now()
+        self.timings['parse'] = self.seconds_elapsed(start, end)
+        logger.info('Parsed datafile %s. Took %0.3f seconds.' 
+                         % (filename, self.timings['parse']))
+
+    def read_header(self, f):
+        '''Read the ticker, date and time above the tables
+
+        Returns the first line of markup.
+        '''
         data = []
         tag_found = False
         while not tag_found:
@@ -120,33 +342,86 @@ class ChainParser():
         ticker, description, date = data
         self.ticker = '-'.join(ticker.split('/'))
         self.date, self.time = date.split('T')
-        soup = BeautifulSoup(line + f.read())
-        underlying, options = soup.findAll('tbody')
-        self.underlying_headers = [th.text for th in underlying.findAll('th')]
-        self.underlying_data = [td.text for td in underlying.findAll('td')]
-        contract_headers = [th.text.lower() for th in options.findAll('th')]
-        self.call_head = contract_headers[1:7]
-        self.put_head = contract_headers[9:-1]
-        self.con_data = [''.join(td.text.split(',')).strip('*')
-                              for td in options.findAll('td')]
-        self.num_headers = len(contract_headers)
-        self.num_contracts = 2*len(self.con_data)/self.num_headers
+        self.dt_date = datetime.strptime(self.date, '%Y-%m-%d').date()
+        self.dt_time = parse_time(self.time)
+        return line
 
-        end = datetime.now()
-        logger.info('Parsed datafile %s. Took %0.3f seconds.' 
-                         % (filename, self.seconds_elapsed(start, end)))
+    def in_manifest(self, filename):
+        '''Check the file's content hash against the ingest manifest'''
+        sha1 = hashlib.sha1()
+        f = open(filename, 'r')
+        self.read_header(f)
+        f.seek(0)
+        chunk = f.read(CHUNKSIZE)
+        while chunk:
+            sha1.update(chunk)
+            chunk = f.read(CHUNKSIZE)
+        f.close()
+        self.sha1 = sha1.hexdigest()
+        key = (self.sha1, self.ticker, self.dt_date, self.dt_time)
+        return self.session.query(IngestManifest).get(key) is not None
 
-    def add_ticker_to_db(self):
-        logger.info('Adding ticker %s' % self.ticker)
-        self.session.add(Ticker(ticker=self.ticker))
+    def add_to_manifest(self, filename):
+        values = {'sha1': self.sha1, 'ticker': self.ticker, 
+                  'date': self.dt_date, 'time': self.dt_time, 
+                  'filename': filename, 'inserted': self.inserted, 
+                  'skipped': self.skipped}
+        if self.sqlite:
+            stmt = IngestManifest.__table__.insert().prefix_with('OR REPLACE')
+        else:
+            stmt = insert(IngestManifest.__table__)
+            stmt = stmt.on_conflict_do_update(
+                        index_elements=['sha1', 'ticker', 'date', 'time'],
+                        set_={'filename': stmt.excluded.filename,
+                              'inserted': stmt.excluded.inserted,
+                              'skipped': stmt.excluded.skipped,
+                              'ingested': func.now()})
+        self.session.execute(stmt.values(values))
         self.session.commit()
 
-    def add_up_to_db(self):
-        logger.info('Adding the price for %s at %s'
-                            % (self.ticker, 'T'.join([self.date, self.time])))
-        start = datetime.now()
+    def soup_tables(self, f, line):
+        soup = BeautifulSoup(line + f.read())
+        return [([th.text for th in tbody.findAll('th')],
+                 [td.text for td in tbody.findAll('td')])
+                for tbody in soup.findAll('tbody')]
+
+    def stream_tables(self, f, line):
+        tsp = TableStreamParser()
+        tsp.feed(line)
+        chunk = f.read(CHUNKSIZE)
+        while chunk:
+            tsp.feed(chunk)
+            chunk = f.read(CHUNKSIZE)
+        tsp.close()
+        return tsp.tbodies
+
+    def gen_snapshot(self, cells):
+        rows = len(cells)/self.num_headers
+        cells = np.array([''.join(td.split(',')).strip('*')
+                          for td in cells[0:rows*self.num_headers]])
+        cells = cells.reshape(rows, self.num_headers)
+
+        expiry = []
+        last_date = None
+        last_label = None
+        for label in cells[:, 7]:
+            if label != last_label:
+                last_label = label
+                last_date = self.get_expiry_date(last_date, label)
+            expiry.append(last_date)
+
+        return ChainSnapshot(self.ticker, self.dt_date, self.time,
+                             self.gen_up_data(),
+                             np.array(expiry, dtype='datetime64[D]'),
+                             cells[:, 8].astype(float),
+                             dict(zip(self.call_head, 
+                                      to_floats(cells[:, 1:7]).T)),
+                             dict(zip(self.put_head, 
+                                      to_floats(cells[:, 9:-1]).T)))
 
-        dic = {'ticker': self.ticker, 'date': self.date, 'time': self.time}
+    def gen_up_data(self):
+        dic = {'ticker': self.ticker, 'date': self.dt_date, 
+               'time': self.dt_time}
         for (h, d) in zip(self.underlying_headers, self.underlying_data):
             if h == 'BxA Size':
                 dic['bid_size'], dic['ask_size'] = \
@@ -158,90 +433,228 @@ class ChainParser():
                 dic['pct_change'] = d.strip('%')
             else:
                 dic[h.lower()] = ''.join(d.split(','))
-        self.session.add(UnderlyingPrice(**dic))
+        return dic
+
+    def add_ticker_to_db(self):
+        logger.info('Adding ticker %s' % self.ticker)
+        start = datetime.now()
+
+        self.session.add(Ticker(ticker=self.ticker))
         self.session.commit()
 
         end = datetime.now()
+        self.timings['ticker'] = self.seconds_elapsed(start, end)
+
+    def add_up_to_db(self):
+        logger.info('Adding the price for %s at %s'
+                            % (self.ticker, 'T'.join([self.date, self.time])))
+        start = datetime.now()
+
+        self.session.add(UnderlyingPrice(**self.snapshot.underlying))
+        self.session.commit()
+
+        end = datetime.now()
+        self.timings['underlying'] = self.seconds_elapsed(start, end)
         logger.info('Adding price complete. Took %0.3f seconds'
-                         % self.seconds_elapsed(start, end))
+                         % self.timings['underlying'])
 
     def add_contracts_to_db(self):
         logger.info('Adding prices for %i contracts...' 
                          % self.num_contracts) 
         start = datetime.now()
 
-        last_date = None
-        last_expiry = None
-        self.count = 0
-        while len(self.con_data) >= self.num_headers:
-            d = self.con_data[0:self.num_headers]
-            self.con_data = self.con_data[self.num_headers:]
-            c_data, expiry, strike, p_data = d[1:7], d[7], d[8], d[9:-1]
-            if last_expiry != expiry:
-                last_expiry = expiry
-                expiry_date = self.get_expiry_date(last_date, expiry)
-                last_date = expiry_date
-            else:
-                expiry_date = last_date
-            base_contract = {'ticker': self.ticker, 'expiry': expiry_date, 
-                             'strike': strike}
-            self.add_price_to_db(base_contract, 'C', self.call_head, c_data)
-            self.add_price_to_db(base_contract, 'P', self.put_head, p_data)
+        snap = self.snapshot
+        expiry = snap.expiry.astype(object)
+        complete = dict([(cp, snap.complete(cp)) for cp in 'CP'])
+        for cp in 'CP':
+            for i in np.flatnonzero(~complete[cp]):
+                logger.warn('No data for %s%s%s%08i on %s' % (self.ticker, 
+                                 expiry[i].strftime('%y%m%d'), cp,
+                                 snap.strike[i]*1000, self.date))
+        self.load_cids(expiry, snap.strike, complete)
+
+        rows = []
+        for cp in 'CP':
+            ok = complete[cp]
+            cols = snap.side(cp)
+            rows += zip(self.get_cids(expiry[ok], cp, snap.strike[ok]),
+                        *[cols[k][ok] for k in PRICECOLS[3:]])
+        if self.sqlite: self.insert_prices_to_db(rows)
+        else: self.copy_prices_to_db(rows)
+        self.add_pairs_to_db(expiry, complete['C'] & complete['P'])
         self.session.commit()
 
         end = datetime.now()
+        self.timings['contracts'] = self.seconds_elapsed(start, end)
         logger.info('Adding contract prices complete. Took %0.3f seconds' 
-                         % self.seconds_elapsed(start, end))
-
-    def add_price_to_db(self, base_contract, call_put, header, data):
-        contract = dict([('call_put', call_put)] + base_contract.items())
-        price = dict(zip(header, data)
-                     + [('date',self.date), ('time',self.time)])
-        missing = len([x for x in price.values() if x.strip() == ''])
-        if missing == 0:
-            price = self.get_cid(contract, price)
-            logger.debug('Got contract id %i' % price['id'])
-            sq = self.session.query(OptionPrice).get((price['id'],
-                                                 price['date'], price['time']))
-            if not sq:
-                self.session.add(OptionPrice(**price))
-                logger.debug('Added the price for contract %i'
-                                  % price['id'])
+                         % self.timings['contracts'])
+
+    def copy_prices_to_db(self, rows):
+        '''COPY the price rows into a staging table and merge them
+
+        Rows whose (id, date, time) is already in option_prices are
+        skipped by ON CONFLICT DO NOTHING rather than checked one by one.
+        '''
+        logger.info('Copying %i prices to db...' % len(rows))
+        start = datetime.now()
+
+        data = ''.join([PRICEFMT % ((r[0], self.date, self.time) + r[1:]) 
+                        for r in rows])
+        self.inserted = self.copy_to_db('option_prices', PRICECOLS, data)
+        self.skipped = len(rows) - self.inserted
+
+        end = datetime.now()
+        self.timings['prices'] = self.seconds_elapsed(start, end)
+        logger.info('Inserted %i prices, skipped %i. Took %0.3f seconds'
+                         % (self.inserted, self.skipped, 
+                            self.timings['prices']))
+
+    def copy_to_db(self, tablename, cols, data):
+        '''COPY tab separated rows into tablename, skipping conflicts
+
+        Returns the number of rows inserted.
+        '''
+        cols = ', '.join(cols)
+        stage = '%s_stage' % tablename
+        cur = self.session.connection().connection.cursor()
+        cur.execute('CREATE TEMP TABLE %s (LIKE %s) ON COMMIT DROP' 
+                    % (stage, tablename))
+        cur.copy_expert('COPY %s (%s) FROM STDIN' % (stage, cols),
+                        StringIO(data))
+        cur.execute('INSERT INTO %s (%s) SELECT %s FROM %s '
+                    'ON CONFLICT DO NOTHING' % (tablename, cols, cols, stage))
+        inserted = cur.rowcount
+        cur.close()
+        return inserted
+
+    def add_pairs_to_db(self, expiry, both):
+        '''Write the option_pairs rows for the snapshot
+
+        expiry      -- an array of datetime.date expiries
+        both        -- the rows where the call and the put are complete
+        '''
+        logger.info('Adding %i call/put pairs...' % both.sum())
+        start = datetime.now()
+
+        snap = self.snapshot
+        up = snap.underlying
+        strike = snap.strike[both]
+        expiry = expiry[both]
+        rows = zip(expiry, strike, snap.days_to_expiry()[both],
+                   self.get_cids(expiry, 'C', strike),
+                   self.get_cids(expiry, 'P', strike),
+                   snap.call_bid[both], snap.call_ask[both], 
+                   snap.put_bid[both], snap.put_ask[both])
+        if self.sqlite:
+            stmt = OptionPair.__table__.insert().prefix_with('OR IGNORE')
+            params = [dict(zip(PAIRCOLS, (self.ticker, self.dt_date, 
+                                          self.dt_time) + r[:2] 
+                                         + (int(r[2]), up['bid'], up['ask'])
+                                         + r[3:]))
+                      for r in rows]
+            if params: pairs = self.session.execute(stmt, params).rowcount
+            else: pairs = 0
         else:
-            logger.warn('No data for %s%s%s%08i on %s' % (self.ticker, 
-                             contract['expiry'].strftime('%y%m%d'), call_put,
-                             float(contract['strike'])*1000, self.date))
+            data = ''.join([PAIRFMT % ((self.ticker, self.date, self.time) 
+                                       + r[:3] + (up['bid'], up['ask']) 
+                                       + r[3:])
+                            for r in rows])
+            pairs = self.copy_to_db('option_pairs', PAIRCOLS, data)
+
+        end = datetime.now()
+        self.timings['pairs'] = self.seconds_elapsed(start, end)
+        logger.info('Added %i call/put pairs. Took %0.3f seconds'
+                         % (pairs, self.timings['pairs']))
+
+    def insert_prices_to_db(self, rows):
+        '''Insert the price rows in one executemany, for sqlite
+
+        INSERT OR IGNORE skips rows already in option_prices the way
+        ON CONFLICT DO NOTHING does for postgresql.
+        '''
+        logger.info('Inserting %i prices to db...' % len(rows))
+        start = datetime.now()
+
+        stmt = OptionPrice.__table__.insert().prefix_with('OR IGNORE')
+        params = [dict(zip(PRICECOLS, (r[0], self.dt_date, self.dt_time)
+                                      + tuple(r[1:5]) + (int(r[5]), 
+                                                         int(r[6]))))
+                  for r in rows]
+        if params: self.inserted = self.session.execute(stmt, params).rowcount
+        else: self.inserted = 0
+        self.skipped = len(rows) - self.inserted
+
+        end = datetime.now()
+        self.timings['prices'] = self.seconds_elapsed(start, end)
+        logger.info('Inserted %i prices, skipped %i. Took %0.3f seconds'
+                         % (self.inserted, self.skipped, 
+                            self.timings['prices']))
 
     def get_expiry_date(self, last_date, expiry):
-        data_dow = self.dt_date.isoweekday()
-        if 'week' in expiry.lower():
-            if last_date: return last_date + td(days=7)
-            else: return self.dt_date + td(days=(6 - data_dow))
-        elif 'q' in expiry.lower():
-            quarter, year = expiry.split('-')
-            month = int(quarter[1])*3
-            year = int(self.dt_date.strftime('%C') + year)
-            c = Calendar()
-            last_day = c.monthdatescalendar(year, month)[-1][-1]
-            while not (last_day.month == month and last_day.isoweekday() <= 5):
-                last_day = last_day - td(days=1)
-            return last_day        
-        else:
-            e_dt = datetime.strptime(expiry, '%b-%y')
-            c = Calendar()
-            fridays = [x[4] 
-                       for x in c.monthdatescalendar(e_dt.year, e_dt.month)]
-            if fridays[0].month == e_dt.month: return fridays[2] + td(days=1)
-            else: return fridays[3] + td(days=1)
-
-    def get_cid(self, con, price):
-        db_con = self.session.query(OptionContract).filter_by(**con).first() 
-        if not db_con:
-            db_con = OptionContract(**con)
-            self.session.add(db_con)
+        return self.calendar.expiry_date(self.dt_date, expiry, last_date)
+
+    def contract_key(self, expiry, call_put, strike):
+        return (expiry, call_put, Decimal('%.3f' % strike))
+
+    def load_cids(self, expiry, strike, complete):
+        '''Map every complete contract in the snapshot to its id
+
+        The ticker's existing contracts at the snapshot's expiries are
+        read in one query, so expired contracts are never loaded, and the
+        missing ones are created in one INSERT ... ON CONFLICT statement.
+        The no-op update on conflict makes RETURNING give back the ids of
+        contracts a concurrent parser created first. The new contracts are
+        inserted in key order so concurrent parsers lock them in the same
+        order and cannot deadlock.
+
+        expiry      -- an array of datetime.date expiries
+        strike      -- an array of strikes
+        complete    -- a dict of 'C' and 'P' to the rows to resolve
+        '''
+        logger.info('Resolving contract ids for %s...' % self.ticker)
+        start = datetime.now()
+
+        q = self.session.query(OptionContract.id, OptionContract.expiry,
+                               OptionContract.call_put, OptionContract.strike)
+        q = q.filter(OptionContract.ticker == self.ticker,
+                     OptionContract.expiry.in_(list(set(expiry))))
+        self.cids = dict([(self.contract_key(*r[1:]), r[0]) for r in q])
+        missing = dict()
+        for cp in 'CP':
+            ok = complete[cp]
+            for e, k in zip(expiry[ok], strike[ok]):
+                key = self.contract_key(e, cp, k)
+                if key not in self.cids: 
+                    missing[key] = {'ticker': self.ticker, 'expiry': e,
+                                    'call_put': cp, 'strike': key[2]}
+        if missing and self.sqlite:
+            stmt = OptionContract.__table__.insert().prefix_with('OR IGNORE')
+            self.session.execute(stmt, missing.values())
+            self.session.commit()
+            self.cids = dict([(self.contract_key(*r[1:]), r[0]) for r in q])
+        elif missing:
+            stmt = insert(OptionContract.__table__).values(
+                        [missing[key] for key in sorted(missing)])
+            stmt = stmt.on_conflict_do_update(
+                        constraint='option_contracts_contract_key',
+                        set_={'ticker': stmt.excluded.ticker})
+            stmt = stmt.returning(OptionContract.id, OptionContract.expiry,
+                                  OptionContract.call_put, 
+                                  OptionContract.strike)
+            r = self.session.execute(stmt)
+            self.cids.update([(self.contract_key(*row[1:]), row[0]) 
+                              for row in r])
             self.session.commit()
-        price['id'] = db_con.id
-        return price
+
+        end = datetime.now()
+        self.timings['cids'] = self.seconds_elapsed(start, end)
+        logger.info('Resolved %i contract ids, %i new. Took %0.3f seconds'
+                         % (len(self.cids), len(missing), 
+                            self.timings['cids']))
+
+    def get_cids(self, expiry, call_put, strike):
+        return [self.cids[self.contract_key(e, call_put, k)] 
+                for e, k in zip(expiry, strike)]
 
     def seconds_elapsed(self, start, end):
         s = (end - start).seconds
@@ -253,4 +666,6 @@ class ChainParser():
 if __name__ == "__main__":
     file_to_parse = sys.argv[1]
     db_name = sys.argv[2]
-    cp = ChainParser(file_to_parse, db_name)
+    streaming = 'stream' in sys.argv[3:]
+    force = 'force' in sys.argv[3:]
+    cp = ChainParser(file_to_parse, db_name, streaming=streaming, force=force)
@@ -0,0 +1,294 @@
+#!/usr/bin/python
+import SocketServer
+import logging
+import socket
+import struct
+
+from finalysis.data_collection.packed_rows import (DEFINE, HEAD, ROW,
+                                                  gen_struct, parse_fields)
+
+HEADER = 'stream'
+FRAMINGS = ('line', 'length')
+ENCODINGS = ('text', 'packed')
+LENGTH = struct.Struct('!I')
+MAXRECORD = 16*1024*1024
+BUFSIZE = 64*1024
+TIMEOUT = 5
+STATS = 'stats'
+ACK = 'ok'
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+class StreamClosed(Exception):
+    pass
+
+class StreamError(Exception):
+    pass
+
+def check_options(framing, encoding):
+    if framing not in FRAMINGS:
+        raise StreamError('framing must be one of %s' % ', '.join(FRAMINGS))
+    if encoding not in ENCODINGS:
+        raise StreamError('encoding must be one of %s'
+                          % ', '.join(ENCODINGS))
+    if encoding == 'packed' and framing != 'length':
+        raise StreamError('packed records need length framing')
+
+def gen_header(framing='line', ack=0, encoding='text'):
+    '''The line a client sends to open a stream'''
+    check_options(framing, encoding)
+    header = [HEADER, framing]
+    if ack: header.append('ack=%i' % ack)
+    if encoding != 'text': header.append('encoding=%s' % encoding)
+    return ' '.join(header) + '\n'
+
+def parse_header(line):
+    '''The framing, ack count and encoding of a stream header line'''
+    fields = line.split()
+    if len(fields) < 2 or fields[0] != HEADER:
+        raise StreamError('bad stream header: %r' % line)
+    ack = 0
+    encoding = 'text'
+    for field in fields[2:]:
+        name, sep, value = field.partition('=')
+        if name == 'ack' and value.isdigit(): ack = int(value)
+        elif name == 'encoding': encoding = value
+        else: raise StreamError('bad stream option: %r' % field)
+    check_options(fields[1], encoding)
+    return fields[1], ack, encoding
+
+def frame(record, framing='line'):
+    '''record as it is sent on a stream with framing'''
+    if isinstance(record, unicode): record = record.encode('utf-8')
+    if framing == 'length': return LENGTH.pack(len(record)) + record
+    if '\n' in record:
+        raise StreamError('line framed records cannot hold newlines')
+    return record + '\n'
+
+class RecordStreamHandler(SocketServer.BaseRequestHandler):
+    '''Reads one-shot messages and framed streams of records
+
+    An old client sends one record and closes the connection, and
+    everything it sent before closing is the record, however long. A
+    streaming client sends a header line first,
+
+        stream line|length [ack=N] [encoding=text|packed]
+
+    and then any number of records over the same connection, each either
+    ended by a newline or preceded by its length as a 4-byte big-endian
+    unsigned int. With ack=N the server answers 'ok accepted rejected'
+    after every N records, after every empty record, which a client can
+    send to close a batch, and once more when the client shuts down its
+    side of the connection. A bad record is logged and counted as
+    rejected without ending the stream. Sending stats instead returns the
+    writer's flush statistics.
+
+    A packed stream, which must be length framed, carries binary records,
+    each starting with a kind and a schema id packed as HEAD. A DEFINE
+    record holds a text message whose packed columns read column:code
+    rather than column=value, and sets the layout of the ROW records with
+    its id. A ROW record holds the values of those columns packed by
+    gen_struct, and is decoded straight to a parameter tuple.
+
+    Subclasses define process(record), which queues the record's row on
+    self.server.writer and returns True, or returns False if the record
+    was rejected, and define(message), which returns the PackedSchema of
+    a definition.
+    '''
+    def setup(self):
+        self.buf = ''
+        self.framing = None
+        self.ack = 0
+        self.encoding = 'text'
+        self.schemas = dict()
+        self.accepted = 0
+        self.rejected = 0
+
+    def fill(self):
+        chunk = self.request.recv(BUFSIZE)
+        if not chunk: raise StreamClosed()
+        self.buf += chunk
+
+    def handle(self):
+        self.request.settimeout(TIMEOUT)
+        try:
+            while len(self.buf) < len(HEADER) + 1 and \
+                  HEADER.startswith(self.buf[:len(HEADER)]):
+                self.fill()
+                if self.buf.strip() == STATS: break
+        except (StreamClosed, socket.timeout): pass
+        if self.buf.strip() == STATS:
+            self.request.sendall(self.server.writer.report() + '\n')
+        elif self.buf.startswith(HEADER + ' '):
+            self.stream()
+        else:
+            self.oneshot()
+
+    def oneshot(self):
+        try:
+            while True: self.fill()
+        except StreamClosed: pass
+        except socket.timeout:
+            logger.warn('No close after %i bytes, taking them as the '
+                        'message', len(self.buf))
+        self.record(self.buf.strip())
+
+    def stream(self):
+        try:
+            while '\n' not in self.buf: self.fill()
+            line, self.buf = self.buf.split('\n', 1)
+            self.framing, self.ack, self.encoding = parse_header(line)
+        except (StreamClosed, socket.timeout, StreamError) as err:
+            logger.error('Stream not opened: %s', err or 'no header')
+            return
+        self.request.settimeout(None)
+        logger.debug('Stream opened with %s framing, ack=%i, %s encoding',
+                     self.framing, self.ack, self.encoding)
+        try:
+            if self.framing == 'line': self.read_lines()
+            else: self.read_lengths()
+        except StreamClosed:
+            if self.framing == 'line' and self.buf.strip():
+                self.record(self.buf.strip())
+            if self.ack: self.send_ack()
+        except StreamError as err:
+            logger.error('Stream closed: %s', err)
+        except socket.error as err:
+            logger.error('Stream lost: %s', err)
+        logger.debug('Stream closed after %i records, %i rejected',
+                     self.accepted + self.rejected, self.rejected)
+
+    def read_lines(self):
+        while True:
+            if '\n' in self.buf:
+                records = self.buf.split('\n')
+                self.buf = records.pop()
+                for record in records: self.record(record.strip())
+            self.fill()
+
+    def read_lengths(self):
+        while True:
+            pos = 0
+            while len(self.buf) - pos >= LENGTH.size:
+                size = LENGTH.unpack_from(self.buf, pos)[0]
+                if size > MAXRECORD:
+                    raise StreamError('record of %i bytes' % size)
+                end = pos + LENGTH.size + size
+                if end > len(self.buf): break
+                self.record(self.buf[pos + LENGTH.size:end])
+                pos = end
+            self.buf = self.buf[pos:]
+            self.fill()
+
+    def record(self, record):
+        if not record:
+            if self.ack: self.send_ack()
+            return
+        try:
+            if self.encoding == 'packed': accepted = self.unpack(record)
+            else: accepted = self.process(record)
+        except Exception as err:
+            logger.error('Record rejected: %s: %s', err.__class__.__name__,
+                         err)
+            accepted = False
+        if accepted is False: self.rejected += 1
+        else: self.accepted += 1
+        if self.ack and not (self.accepted + self.rejected) % self.ack:
+            self.send_ack()
+
+    def send_ack(self):
+        try:
+            self.request.sendall('%s %i %i\n' % (ACK, self.accepted,
+                                                 self.rejected))
+        except socket.error as err:
+            logger.error('Ack not sent: %s', err)
+
+    def unpack(self, record):
+        kind, schema_id = HEAD.unpack_from(record)
+        if kind == ROW:
+            if schema_id not in self.schemas:
+                raise StreamError('schema %i is not defined' % schema_id)
+            schema = self.schemas[schema_id]
+            self.server.writer.add(schema.engine, schema.table,
+                                   schema.decode(record), schema.columns)
+        elif kind == DEFINE:
+            self.schemas[schema_id] = self.define(record[HEAD.size:])
+            logger.info('Schema %i is %s for %s', schema_id,
+                        self.schemas[schema_id].struct.format,
+                        self.schemas[schema_id].table.fullname)
+        else:
+            raise StreamError('unknown record kind %r' % kind)
+        return True
+
+    def process(self, record):
+        raise NotImplementedError
+
+    def define(self, message):
+        raise NotImplementedError
+
+class RecordStream():
+    '''A client that keeps one connection open to an ingest server
+
+    framing     -- line or length, see RecordStreamHandler
+    ack         -- have the server acknowledge every ack records
+    encoding    -- text or packed, which needs length framing
+    timeout     -- seconds to wait for the connection or an ack
+    '''
+    def __init__(self, host, port, framing='line', ack=0, encoding='text',
+                 timeout=TIMEOUT):
+        self.framing = framing
+        self.ack = ack
+        self.sent = 0
+        self.structs = dict()
+        header = gen_header(framing, ack, encoding)
+        self.sock = socket.create_connection((host, port), timeout)
+        self.rfile = self.sock.makefile('rb')
+        self.sock.sendall(header)
+
+    def define(self, schema_id, definition):
+        '''Send a packed row layout, a message whose packed columns read
+        column:code, and return what send does'''
+        if isinstance(definition, unicode):
+            definition = definition.encode('utf-8')
+        fields = [f.strip() for f in definition.split(',')]
+        packed = parse_fields([f for f in fields if '=' in f or ':' in f])[1]
+        self.structs[schema_id] = gen_struct([code for name, code in packed])
+        return self.send([HEAD.pack(DEFINE, schema_id) + definition])
+
+    def pack(self, schema_id, values):
+        '''A row record of values in the order of schema_id's packed
+        columns'''
+        packed = self.structs[schema_id].pack(*values)
+        return HEAD.pack(ROW, schema_id) + packed
+
+    def send(self, records):
+        '''Send a batch of records, and with acks on return the server's
+        (accepted, rejected) counts once it has taken the batch'''
+        data = ''.join([frame(r, self.framing) for r in records])
+        self.sent += len(records)
+        if not self.ack:
+            self.sock.sendall(data)
+            return None
+        acks = self.sent/self.ack - (self.sent - len(records))/self.ack
+        self.sock.sendall(data + frame('', self.framing))
+        for i in range(acks + 1): counts = self.read_ack()
+        return counts
+
+    def read_ack(self):
+        line = self.rfile.readline()
+        fields = line.split()
+        if len(fields) != 3 or fields[0] != ACK:
+            raise StreamError('bad ack: %r' % line)
+        return int(fields[1]), int(fields[2])
+
+    def close(self):
+        '''Close the stream, returning the final counts with acks'''
+        counts = None
+        try:
+            self.sock.shutdown(socket.SHUT_WR)
+            if self.ack: counts = self.read_ack()
+        finally:
+            self.rfile.close()
+            self.sock.close()
+        return counts
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+import logging
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.schema import CreateSchema
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+BACKENDS = ('postgresql', 'sqlite')
+
+engines = dict()
+ensured = set()
+sqlite_schemas = dict()
+orphaned_pools = []
+owner_pid = os.getpid()
+
+def gen_dburl(dbname, dbhost='', backend='postgresql'):
+    '''Build a db url
+
+    dbname      -- the db name, or the db file for sqlite
+    dbhost      -- user:password@host:port, ignored for sqlite
+    backend     -- one of BACKENDS
+    '''
+    assert backend in BACKENDS
+    if backend == 'sqlite': return 'sqlite:///%s' % dbname
+    return 'postgresql+psycopg2://%s/%s' % (dbhost, dbname)
+
+def is_sqlite(engine):
+    return engine.dialect.name == 'sqlite'
+
+def init_sqlite(engine):
+    '''Set up every new sqlite connection for bulk loading
+
+    Schemas are sqlite databases attached under the schema name, each in
+    its own file next to the main one.
+    '''
+    dburl = str(engine.url)
+    dbfile = engine.url.database
+    sqlite_schemas[dburl] = set()
+
+    def on_connect(dbapi_conn, record):
+        cur = dbapi_conn.cursor()
+        cur.execute('PRAGMA journal_mode=WAL')
+        cur.execute('PRAGMA synchronous=NORMAL')
+        for schema in sqlite_schemas[dburl]:
+            if dbfile and dbfile != ':memory:': 
+                schemafile = '%s.%s' % (dbfile, schema)
+            else: schemafile = ':memory:'
+            cur.execute('ATTACH DATABASE ? AS "%s"' % schema, (schemafile,))
+        cur.close()
+
+    event.listen(engine, 'connect', on_connect)
+
+def check_fork():
+    '''Give a forked child its own connection pools
+
+    The pools inherited from the parent hold sockets the parent is still
+    using, so they are swapped for fresh pools rather than disposed. The
+    old pools are kept referenced so their connections are never closed,
+    and thereby terminated, from the child.
+    '''
+    global owner_pid
+    if os.getpid() == owner_pid: return
+    for engine in engines.values():
+        orphaned_pools.append(engine.pool)
+        engine.pool = engine.pool.recreate()
+    owner_pid = os.getpid()
+    logger.debug('Replaced %i inherited connection pools' % len(engines))
+
+def get_engine(dburl, **kwargs):
+    '''Return the process-wide engine for dburl, creating it if need be
+
+    kwargs are passed to create_engine the first time dburl is seen.
+    '''
+    check_fork()
+    if dburl not in engines:
+        if dburl.startswith('sqlite'):
+            kwargs.setdefault('connect_args', {'timeout': 60})
+        engines[dburl] = create_engine(dburl, **kwargs)
+        if is_sqlite(engines[dburl]): init_sqlite(engines[dburl])
+    return engines[dburl]
+
+def ensure_schema(engine, schema):
+    key = (str(engine.url), schema)
+    if key in ensured: return
+    if is_sqlite(engine):
+        sqlite_schemas[str(engine.url)].add(schema)
+        engine.dispose()
+    else:
+        try: engine.execute(CreateSchema(schema))
+        except ProgrammingError: pass
+    ensured.add(key)
+
+def ensure_tables(engine, metadata, schema=None):
+    '''Create the schema and the metadata's tables once per process
+
+    Later calls for the same db and tables return without touching the
+    db, so per-request code can call this freely.
+    '''
+    key = (str(engine.url), schema, tuple(sorted(metadata.tables)))
+    if key in ensured: return
+    schemas = set([t.schema for t in metadata.tables.values() if t.schema])
+    if schema: schemas.add(schema)
+    for s in sorted(schemas): ensure_schema(engine, s)
+    metadata.create_all(engine)
+    ensured.add(key)
+
+def gen_upsert(engine, table, update=True, columns=None):
+    '''Build an insert for executemany that resolves primary key conflicts
+
+    With update the conflicting row takes the new values, otherwise the
+    new row is dropped. Given columns, only those are updated, so rows
+    that leave columns out keep the stored values. sqlite's OR REPLACE
+    always replaces the whole row.
+    '''
+    if is_sqlite(engine):
+        if update: return table.insert().prefix_with('OR REPLACE')
+        else: return table.insert().prefix_with('OR IGNORE')
+    stmt = insert(table)
+    pkey = [c.name for c in table.primary_key]
+    values = dict([(c.name, stmt.excluded[c.name]) for c in table.c 
+                   if not c.primary_key 
+                   and (columns is None or c.name in columns)])
+    if not update or not values: 
+        return stmt.on_conflict_do_nothing(index_elements=pkey)
+    return stmt.on_conflict_do_update(index_elements=pkey, set_=values)
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+from calendar import Calendar
+from datetime import datetime
+from datetime import timedelta as td
+import logging
+
+from sqlalchemy import MetaData
+from sqlalchemy.exc import DBAPIError
+
+from finalysis.holidays_orm import gen_table
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+calendars = dict()
+
+def load_holidays(engine, tablename='holidays', schema=None):
+    '''Return a dict of date to holiday name from a holidays_orm table
+
+    An empty dict is returned if the table cannot be read.
+    '''
+    table = gen_table(tablename, MetaData(), schema=schema)
+    conn = engine.connect()
+    try:
+        rows = conn.execute(table.select()).fetchall()
+    except DBAPIError as err:
+        logger.warn('Could not load holidays: %s' % err)
+        return dict()
+    finally:
+        conn.close()
+    return dict([(row['date'], row['holiday']) for row in rows])
+
+def get_calendar(engine, tablename='holidays', schema=None):
+    '''Return the process-wide ExpiryCalendar for a db
+
+    The holidays are read from the db the first time a calendar is asked
+    for, so long-running processes share one calendar and its cache.
+    '''
+    key = (str(engine.url), tablename, schema)
+    if key not in calendars:
+        calendars[key] = ExpiryCalendar(load_holidays(engine, tablename, 
+                                                      schema))
+    return calendars[key]
+
+class ExpiryCalendar():
+    '''Option expiry dates for the labels used in the chain files
+
+    Monthlies expire on the Saturday after the third Friday and quarterlies
+    on the last trading day of the quarter's final month. Weeklies expire
+    on a Saturday, the first one falling in the week of the data and each
+    later one a week after the expiry listed before it. Saturday expiries
+    are the contract's expiration date and are left alone; last trading
+    day expiries step back over weekends and holidays.
+
+    holidays    -- a dict or set of exchange holiday dates
+    years       -- the years to precompute
+    '''
+    def __init__(self, holidays=None, years=None):
+        self.holidays = holidays or dict()
+        self.monthlies = dict()
+        self.quarterlies = dict()
+        self.cache = dict()
+        self.c = Calendar()
+        this_year = datetime.now().year
+        for year in years or range(this_year - 5, this_year + 4):
+            self.add_year(year)
+
+    def add_year(self, year):
+        for month in range(1, 13):
+            fridays = [x[4] for x in self.c.monthdatescalendar(year, month)]
+            if fridays[0].month == month: third = fridays[2]
+            else: third = fridays[3]
+            self.monthlies[(year, month)] = third + td(days=1)
+        for quarter in range(1, 5):
+            month = quarter*3
+            last_day = self.c.monthdatescalendar(year, month)[-1][-1]
+            while last_day.month != month: last_day -= td(days=1)
+            self.quarterlies[(year, quarter)] = self.last_trading_day(last_day)
+
+    def is_trading_day(self, date):
+        return date.isoweekday() <= 5 and date not in self.holidays
+
+    def last_trading_day(self, date):
+        '''The last trading day on or before date'''
+        while not self.is_trading_day(date): date -= td(days=1)
+        return date
+
+    def monthly(self, year, month):
+        if (year, month) not in self.monthlies: self.add_year(year)
+        return self.monthlies[(year, month)]
+
+    def quarterly(self, year, quarter):
+        if (year, quarter) not in self.quarterlies: self.add_year(year)
+        return self.quarterlies[(year, quarter)]
+
+    def expiry_date(self, data_date, label, last_date=None):
+        '''Map a chain file's expiry label to its expiry date
+
+        data_date   -- the datetime.date of the chain file
+        label       -- 'Weekly n', 'Qn-yy' or 'Mon-yy'
+        last_date   -- the expiry of the label listed before this one,
+                       which is what a weekly is counted from
+        '''
+        if 'week' not in label.lower(): last_date = None
+        key = (data_date, label, last_date)
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+
+        if 'week' in label.lower():
+            if last_date: expiry = last_date + td(days=7)
+            else: expiry = data_date + td(days=(6 - data_date.isoweekday()))
+        elif 'q' in label.lower():
+            quarter, year = label.split('-')
+            year = int(data_date.strftime('%C') + year)
+            expiry = self.quarterly(year, int(quarter[1]))
+        else:
+            e_dt = datetime.strptime(label, '%b-%y')
+            expiry = self.monthly(e_dt.year, e_dt.month)
+        self.cache[key] = expiry
+        return expiry
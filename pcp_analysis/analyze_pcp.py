@@ -8,13 +8,16 @@ import logging
 import re
 import sys
 
-from sqlalchemy import create_engine
+import numpy as np
 from sqlalchemy.orm import aliased, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
+from finalysis.db_registry import gen_dburl, get_engine
 from finalysis.data_collection.parse_option_chain import (UnderlyingPrice,
                                                           OptionContract,
-                                                          OptionPrice)
+                                                          OptionPrice,
+                                                          OptionPair,
+                                                          parse_time)
 
 logger_format = ('%(levelno)s, [%(asctime)s #%(process)d]'
                     + '%(levelname)8s: %(message)s')
@@ -33,16 +36,26 @@ call_contract = aliased(OptionContract, name='contract')
 put_contract = aliased(OptionContract)
 call = aliased(OptionPrice, name='call')
 put = aliased(OptionPrice, name='put')
+pair = OptionPair
+
+CURVE_METHODS = ('median', 'trimmed')
+CURVEBAND = 0.01
+MAXDAYS = 10
+
+# The latest snapshot's curve per ticker, as (date, time, curve)
+curves = dict()
+
+PRICECOLS = ('stock_bid', 'stock_ask', 'call_bid', 'call_ask', 'put_bid',
+             'put_ask', 'contract_strike')
 
 class PCPAnalyzer():
 
-    def __init__(self, dbname, dbhost=''):
-        self.init_db_connection(dbname, dbhost)
+    def __init__(self, dbname, dbhost='', backend='postgresql'):
+        self.init_db_connection(dbname, dbhost, backend)
 
-    def init_db_connection(self, dbname, dbhost):
+    def init_db_connection(self, dbname, dbhost, backend='postgresql'):
         logger.debug('Connecting to db %s...' % dbname)
-        dburl = 'postgresql+psycopg2://%s/%s' % (dbhost, dbname)
-        self.engine = create_engine(dburl)
+        self.engine = get_engine(gen_dburl(dbname, dbhost, backend))
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
         logger.debug('Connected to db %s' % dbname)
@@ -95,6 +108,190 @@ class PCPAnalyzer():
         sl_cash += (row['stock_ask'] + row['put_ask'])
         return ls_cash, sl_cash
 
+    def to_columns(self, rows):
+        '''Turn base_query result rows into a dict of column arrays
+
+        The price columns become float arrays, stock_date and
+        contract_expiry datetime64[D] arrays, and days_to_expiry is added.
+        Other columns become object arrays.
+        '''
+        if not rows: return None
+        cols = dict(zip(rows[0].keys(), zip(*rows)))
+        for col in cols: cols[col] = np.array(cols[col], dtype=object)
+        for col in PRICECOLS: cols[col] = np.array(cols[col], dtype=float)
+        for col in ['stock_date', 'contract_expiry']:
+            cols[col] = np.array(cols[col], dtype='datetime64[D]')
+        cols['days_to_expiry'] = (cols['contract_expiry'] 
+                                  - cols['stock_date']).astype(int)
+        return cols
+
+    def snapshot_columns(self, snap):
+        '''The to_columns dict for a parsed ChainSnapshot, without the db
+
+        The snapshot already pairs each call with the put at the same
+        expiry and strike. Rows missing either side are dropped, as they
+        are never stored for base_query to find. There are no call_id or
+        put_id columns.
+        '''
+        ok = snap.complete('C') & snap.complete('P')
+        n = ok.sum()
+        cols = {'stock_ticker': np.array([snap.ticker]*n, dtype=object),
+                'stock_date': np.repeat(np.datetime64(snap.date, 'D'), n),
+                'stock_time': np.array([parse_time(snap.time)]*n, 
+                                       dtype=object),
+                'stock_bid': np.repeat(snap.stock_bid, n),
+                'stock_ask': np.repeat(snap.stock_ask, n),
+                'contract_expiry': snap.expiry[ok],
+                'contract_strike': snap.strike[ok],
+                'days_to_expiry': snap.days_to_expiry()[ok]}
+        for cp in ['call', 'put']:
+            for h in ['bid', 'ask']:
+                col = '%s_%s' % (cp, h)
+                cols[col] = getattr(snap, col)[ok]
+        return cols
+
+    def select(self, cols, mask):
+        '''The rows of a column dict where mask is True'''
+        return dict([(k, v[mask]) for k, v in cols.items()])
+
+    def candidates(self, cols, max_days=MAXDAYS):
+        '''The rows a reversal would be traded on, those with the stock bid
+        above the strike that expire within max_days'''
+        return ((cols['stock_bid'] > cols['contract_strike'])
+                & (cols['days_to_expiry'] <= max_days))
+
+    def column_row(self, cols, i):
+        '''Row i of a column dict as a dict of python values, in the form
+        gen_contract_id and the row methods expect'''
+        row = dict([(k, v[i]) for k, v in cols.items()])
+        for col in ['stock_date', 'contract_expiry']:
+            row[col] = row[col].astype(object)
+        return row
+
+    def batch_solve_for_r(self, numerator, desc, cols):
+        '''Vectorized solve_for_r, NaN where the rate is None
+
+        As in solve_for_r, a row expiring on the data date keeps the log
+        ratio without annualizing it.
+        '''
+        days = cols['days_to_expiry']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = np.log(numerator) - np.log(cols['contract_strike'])
+            rate = np.where(days != 0, rate*(-365.0/days), rate)
+        bad = numerator <= 0
+        if bad.any():
+            rate[bad] = np.nan
+            errmsg = '%s call exceeds stock plus put for %i of %i rows'
+            logger.error(errmsg % (desc, bad.sum(), len(bad)))
+        return rate
+
+    def batch_zero_cash_in_rates(self, cols):
+        '''Vectorized zero_cash_in_rates over the output of to_columns'''
+        ls_num = cols['stock_bid'] + cols['put_bid'] - cols['call_ask']
+        sl_num = cols['stock_ask'] + cols['put_ask'] - cols['call_bid']
+        return (self.batch_solve_for_r(ls_num, 'Long-short', cols),
+                self.batch_solve_for_r(sl_num, 'Short-long', cols))
+
+    def batch_cash_out_today(self, cols, r_lend, r_borrow):
+        '''Vectorized cash_out_today over the output of to_columns
+
+        The results are floats, so they match cash_out_today to within the
+        12 digits it keeps of each discount factor. The rates may be arrays
+        with a rate per row, as from curve_rates.
+        '''
+        days = cols['days_to_expiry']
+        strike = cols['contract_strike']
+        ls_cash = cols['call_ask'] + strike*np.exp(-r_lend*days/365.0)
+        ls_cash -= (cols['stock_bid'] + cols['put_bid'])
+        sl_cash = -cols['call_bid'] - strike*np.exp(-r_borrow*days/365.0)
+        sl_cash += (cols['stock_ask'] + cols['put_ask'])
+        return ls_cash, sl_cash
+
+    def batch_evaluate(self, rows, r_lend, r_borrow):
+        '''Cash outs and implied rates for every row in one pass
+
+        rows        -- base_query results for a snapshot or a date range
+        r_lend      -- the lending rate for the long-short cash out
+        r_borrow    -- the borrowing rate for the short-long cash out
+
+        Returns the to_columns dict with ls_cash, sl_cash, ls_rate and
+        sl_rate arrays added, or None if there are no rows.
+        '''
+        return self.evaluate_columns(self.to_columns(rows), r_lend, r_borrow)
+
+    def evaluate_columns(self, cols, r_lend, r_borrow):
+        '''batch_evaluate for the output of to_columns or snapshot_columns'''
+        if cols is None: return None
+        cols['ls_cash'], cols['sl_cash'] = self.batch_cash_out_today(cols,
+                                                                     r_lend,
+                                                                     r_borrow)
+        cols['ls_rate'], cols['sl_rate'] = self.batch_zero_cash_in_rates(cols)
+        return cols
+
+    def rate_curve(self, cols, method='median', trim=0.1, min_strikes=3):
+        '''Implied lend and borrow rates per expiry for one snapshot
+
+        The zero-cash-in rates of every strike at an expiry are combined
+        with their median, or with their mean after dropping the trim
+        fraction at each end. The long-short rates give the lend rate and
+        the short-long rates the borrow rate.
+
+        cols        -- to_columns or snapshot_columns for a single snapshot
+        method      -- one of CURVE_METHODS
+        trim        -- the fraction cut from each end for 'trimmed'
+        min_strikes -- fewer usable rates than this gives nan
+
+        Returns a dict of datetime64[D] expiry to (lend, borrow). Strikes
+        with no solution and expiries on the data date are left out.
+        '''
+        assert method in CURVE_METHODS
+        ls_rate, sl_rate = self.batch_zero_cash_in_rates(cols)
+        live = cols['days_to_expiry'] > 0
+        curve = dict()
+        for expiry in np.unique(cols['contract_expiry']):
+            rows = live & (cols['contract_expiry'] == expiry)
+            rates = []
+            for rate in [ls_rate[rows], sl_rate[rows]]:
+                rate = np.sort(rate[~np.isnan(rate)])
+                if len(rate) < min_strikes: rates.append(np.nan)
+                elif method == 'median': rates.append(np.median(rate))
+                else:
+                    cut = int(len(rate)*trim)
+                    rates.append(rate[cut:len(rate) - cut].mean())
+            curve[expiry] = tuple(rates)
+        return curve
+
+    def implied_curve(self, cols, **kwargs):
+        '''rate_curve, cached for the latest snapshot of each ticker
+
+        kwargs are passed to rate_curve the first time a snapshot is seen.
+        Only one curve is kept per ticker, so a long-lived process that
+        sees a new snapshot with every file does not grow.
+        '''
+        ticker = cols['stock_ticker'][0]
+        key = (cols['stock_date'][0], cols['stock_time'][0])
+        if ticker not in curves or curves[ticker][0:2] != key:
+            curves[ticker] = key + (self.rate_curve(cols, **kwargs),)
+        return curves[ticker][2]
+
+    def curve_rates(self, cols, curve, r_lend, r_borrow, band=CURVEBAND):
+        '''The curve's lend and borrow rates for each row of cols
+
+        The curve sits at the middle of the snapshot's own rates, so about
+        half of its strikes would price below zero against it. The lend
+        rate is lowered and the borrow rate raised by band, so a strike is
+        only mispriced when its rate is more than band from the curve.
+        Rows whose expiry is missing from the curve, or whose curve rate is
+        nan, get r_lend and r_borrow as they are.
+        '''
+        rates = np.array([curve.get(e, (np.nan, np.nan)) 
+                          for e in cols['contract_expiry']], dtype=float)
+        rates = rates.reshape(-1, 2)
+        lend = np.where(np.isnan(rates[:, 0]), r_lend, rates[:, 0] - band)
+        borrow = np.where(np.isnan(rates[:, 1]), r_borrow, 
+                          rates[:, 1] + band)
+        return lend, borrow
+
     def base_query(self):
         q = self.session.query(
                                stock.date,
@@ -125,6 +322,29 @@ class PCPAnalyzer():
                 filter(put_contract.id==put.id)
         return q
 
+    def pair_query(self):
+        '''base_query's columns, read from the option_pairs table
+
+        Filter on pair.ticker, pair.date, pair.time and
+        pair.days_to_expiry to scan the table's indexes.
+        '''
+        q = self.session.query(
+                               pair.date.label('stock_date'),
+                               pair.time.label('stock_time'),
+                               pair.ticker.label('stock_ticker'),
+                               pair.stock_ask.label('stock_ask'),
+                               pair.stock_bid.label('stock_bid'),
+                               pair.call_id.label('call_id'),
+                               pair.put_id.label('put_id'),
+                               pair.expiry.label('contract_expiry'),
+                               pair.strike.label('contract_strike'),
+                               pair.call_ask.label('call_ask'),
+                               pair.call_bid.label('call_bid'),
+                               pair.put_ask.label('put_ask'),
+                               pair.put_bid.label('put_bid')
+                               )
+        return q
+
 
 # For running from command line
 if __name__ == "__main__":
@@ -135,16 +355,17 @@ if __name__ == "__main__":
     lend_rate = float(sys.argv[5])
     borrow_rate = float(sys.argv[6])
     p = PCPAnalyzer(db_name, dbhost=db_host)
-    r = p.session.execute(p.base_query().\
-                              filter(stock.date == date).\
-                              filter(stock.ticker == ticker).\
-                              filter(call.bid > 0, put.bid > 0).\
-                              order_by(call_contract.id, 
-                                       stock.date, 
-                                       stock.time).\
+    r = p.session.execute(p.pair_query().\
+                              filter(pair.date == date).\
+                              filter(pair.ticker == ticker).\
+                              filter(pair.call_bid > 0, pair.put_bid > 0).\
+                              order_by(pair.call_id, 
+                                       pair.date, 
+                                       pair.time).\
                               limit(10000)).\
                           fetchall()
-    for i in r:
-        print i['stock_date'], i['stock_time'], i['stock_ask'], i['stock_bid'], i['stock_ask']-i['stock_bid'], p.gen_contract_id(i, 'C'), p.gen_contract_id(i, 'P'), p.cash_in_today(i, lend_rate, borrow_rate)
+    cols = p.batch_evaluate(r, lend_rate, borrow_rate)
+    for n, i in enumerate(r):
+        print i['stock_date'], i['stock_time'], i['stock_ask'], i['stock_bid'], i['stock_ask']-i['stock_bid'], p.gen_contract_id(i, 'C'), p.gen_contract_id(i, 'P'), cols['ls_cash'][n], cols['sl_cash'][n]
 
     p.session.close()
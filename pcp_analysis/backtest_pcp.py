@@ -0,0 +1,184 @@
+#!/usr/bin/python
+from datetime import datetime
+from itertools import groupby
+from multiprocessing import Pool, cpu_count
+import argparse
+import csv
+import sys
+
+import numpy as np
+
+from finalysis.data_collection.parse_option_chain import UnderlyingPrice
+from finalysis.db_registry import BACKENDS
+from finalysis.pcp_analysis import analyze_pcp as apcp
+
+STATCOLS = ['ticker', 'date', 'snapshots', 'pairs', 'candidates', 'ls_count',
+            'sl_count', 'ls_trades', 'sl_trades', 'ls_min', 'sl_min', 'ls_mean',
+            'sl_mean', 'seconds']
+
+analyzer = None
+
+def init_worker(db_name, db_host, backend):
+    '''Give the worker process the analyzer it runs every partition with'''
+    global analyzer
+    analyzer = apcp.PCPAnalyzer(db_name, dbhost=db_host, backend=backend)
+
+def stream_rows(result, chunksize):
+    '''Yield the rows of a result, fetching chunksize rows at a time'''
+    chunk = result.fetchmany(chunksize)
+    while chunk:
+        for row in chunk: yield row
+        chunk = result.fetchmany(chunksize)
+
+def gen_query(ticker, date, pairs):
+    if pairs:
+        return analyzer.pair_query().\
+                   filter(apcp.pair.ticker == ticker).\
+                   filter(apcp.pair.date == date).\
+                   filter(apcp.pair.call_bid > 0, apcp.pair.put_bid > 0).\
+                   order_by(apcp.pair.time)
+    return analyzer.base_query().\
+               filter(apcp.stock.ticker == ticker).\
+               filter(apcp.stock.date == date).\
+               filter(apcp.call.bid > 0, apcp.put.bid > 0).\
+               order_by(apcp.stock.time)
+
+def backtest(job):
+    '''Scan one (ticker, date) partition a snapshot at a time
+
+    The rows are read through a server-side cursor, so only one chunk and
+    the snapshot being evaluated are held in memory. Like the server, the
+    implied curve is built from every pair, and the statistics count only
+    the candidates the server would trade.
+    '''
+    (ticker, date, lend, borrow, implied, band, max_days, threshold,
+     chunksize, pairs) = job
+    start = datetime.now()
+    stats = dict([(col, 0) for col in STATCOLS])
+    stats.update({'ticker': ticker, 'date': date, 'ls_min': np.nan,
+                  'sl_min': np.nan, 'ls_mean': np.nan, 'sl_mean': np.nan})
+    totals = {'ls': 0.0, 'sl': 0.0}
+    conn = analyzer.engine.connect().execution_options(stream_results=True)
+    try:
+        query = gen_query(ticker, date, pairs)
+        result = conn.execute(query.with_labels().statement)
+        for time, snapshot in groupby(stream_rows(result, chunksize),
+                                      lambda row: row['stock_time']):
+            cols = analyzer.to_columns(list(snapshot))
+            if implied:
+                # Not implied_curve, as no snapshot is seen twice
+                curve = analyzer.rate_curve(cols)
+                r_lend, r_borrow = analyzer.curve_rates(cols, curve, lend,
+                                                        borrow, band)
+            else: r_lend, r_borrow = lend, borrow
+            cols = analyzer.evaluate_columns(cols, r_lend, r_borrow)
+            candidates = analyzer.candidates(cols, max_days)
+            stats['snapshots'] += 1
+            stats['pairs'] += len(cols['contract_strike'])
+            stats['candidates'] += candidates.sum()
+            for side in totals:
+                cash = cols['%s_cash' % side][candidates]
+                cash = cash[cash < 0]
+                if not len(cash): continue
+                totals[side] += cash.sum()
+                stats['%s_count' % side] += len(cash)
+                stats['%s_trades' % side] += (cash < threshold).sum()
+                stats['%s_min' % side] = np.nanmin([stats['%s_min' % side],
+                                                    cash.min()])
+        result.close()
+    except Exception as err:
+        apcp.logger.error('Backtest of %s on %s failed: %s'
+                          % (ticker, date, err))
+        return None
+    finally:
+        conn.close()
+    for side in totals:
+        count = stats['%s_count' % side]
+        if count: stats['%s_mean' % side] = totals[side]/count
+    stats['seconds'] = analyzer.seconds_elapsed(start, datetime.now())
+    return stats
+
+def gen_partitions(start_date, end_date, tickers):
+    '''The (ticker, date) pairs with underlying prices in the date range'''
+    q = analyzer.session.query(UnderlyingPrice.ticker,
+                               UnderlyingPrice.date).distinct().\
+            filter(UnderlyingPrice.date >= start_date).\
+            filter(UnderlyingPrice.date <= end_date)
+    if tickers: q = q.filter(UnderlyingPrice.ticker.in_(tickers))
+    partitions = q.order_by(UnderlyingPrice.date, UnderlyingPrice.ticker).all()
+    analyzer.session.close()
+    return partitions
+
+if __name__ == '__main__':
+    description = 'Scan the chains in a date range for PCP mispricings.'
+
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument('db_name', type=str)
+    p.add_argument('start_date', type=str, help='YYYY-MM-DD')
+    p.add_argument('end_date', type=str, help='YYYY-MM-DD, inclusive')
+    p.add_argument('lend_rate', type=float)
+    p.add_argument('borrow_rate', type=float)
+    p.add_argument('--tickers', type=str, nargs='+',
+                   help='Default is every ticker in the db')
+    p.add_argument('--db_host', type=str, default='',
+                   help='user:password@host:port, as used by sqlalchemy')
+    p.add_argument('--backend', type=str, default='postgresql',
+                   choices=BACKENDS,
+                   help='Default is postgresql. For sqlite db_name is a file')
+    p.add_argument('--processes', type=int, default=cpu_count(),
+                   help='Default is the number of cpus, %i' % cpu_count())
+    p.add_argument('--chunksize', type=int, default=5000,
+                   help='Rows fetched from the cursor at a time. '
+                        'Default is 5000')
+    p.add_argument('--max_days', type=int, default=apcp.MAXDAYS,
+                   help='Only count expiries at most this many days out, '
+                        'as the server does. Default is %i' % apcp.MAXDAYS)
+    p.add_argument('--threshold', type=float, default=-0.04,
+                   help='Cash out below which a trade would be sent. '
+                        'Default is -0.04')
+    p.add_argument('--implied', action='store_true',
+                   help='Price against each snapshot\'s implied rate curve, '
+                        'falling back to the given rates')
+    p.add_argument('--band', type=float, default=apcp.CURVEBAND,
+                   help='With --implied, how far a strike\'s rate must be '
+                        'from the curve to be mispriced. Default is %s'
+                        % apcp.CURVEBAND)
+    p.add_argument('--pairs', action='store_true',
+                   help='Read the option_pairs table instead of joining '
+                        'the price tables')
+    p.add_argument('--output', type=str, default='pcp_backtest.csv',
+                   help='Default is pcp_backtest.csv')
+    args = p.parse_args()
+
+    init_worker(args.db_name, args.db_host, args.backend)
+    partitions = gen_partitions(args.start_date, args.end_date, args.tickers)
+    if not partitions: sys.exit('No data in the date range')
+
+    jobs = [(ticker, date, args.lend_rate, args.borrow_rate, args.implied,
+             args.band, args.max_days, args.threshold, args.chunksize, args.pairs)
+            for ticker, date in partitions]
+    pool = Pool(args.processes, init_worker,
+                (args.db_name, args.db_host, args.backend))
+    start = datetime.now()
+    done = 0
+    failed = 0
+    pairs = 0
+    with open(args.output, 'wb') as f:
+        writer = csv.DictWriter(f, STATCOLS)
+        writer.writeheader()
+        for stats in pool.imap_unordered(backtest, jobs):
+            if stats is None:
+                failed += 1
+                continue
+            done += 1
+            pairs += stats['pairs']
+            writer.writerow(stats)
+            f.flush()
+            print '%s %s: %i snapshots, %i long-short, %i short-long' \
+                  % (stats['ticker'], stats['date'], stats['snapshots'],
+                     stats['ls_count'], stats['sl_count'])
+    pool.close()
+    pool.join()
+    elapsed = (datetime.now() - start).total_seconds()
+    print 'Scanned %i partitions (%i failed), %i pairs in %0.3f s' \
+          % (done, failed, pairs, elapsed)
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+from fnmatch import fnmatch
+from time import sleep, time
+import os
+
+try: import pyinotify
+except ImportError: pyinotify = None
+
+PATTERN = '*.html'
+SETTLE = 0.5
+POLL = 0.2
+
+class DirWatcher():
+    '''Find the chain files that land in a directory once they are whole
+
+    A file is a candidate when it appears or changes, and is ready once
+    it has gone settle seconds without changing, so a file still being
+    written is not picked up half done. With pyinotify installed, close
+    and move events mark the candidates. Otherwise the directory is
+    listed every poll seconds and a candidate is any file whose size or
+    mtime differs from the last listing. Files already there when the
+    watcher starts are ignored.
+
+    directory   -- the drop directory
+    pattern     -- a glob the file names must match
+    settle      -- seconds without a change before a file is ready
+    poll        -- seconds between listings, or the inotify wait
+    inotify     -- use pyinotify if it is installed
+    '''
+    def __init__(self, directory, pattern=PATTERN, settle=SETTLE,
+                 poll=POLL, inotify=True):
+        self.directory = os.path.abspath(directory)
+        self.pattern = pattern
+        self.settle = settle
+        self.poll = poll
+        self.candidates = dict()
+        self.pending = []
+        self.seen = dict()
+        self.notifier = None
+        if inotify and pyinotify: self.init_inotify()
+        else: self.seen = self.listing()
+
+    def init_inotify(self):
+        changed = self.changed
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event): changed(event.pathname)
+        wm = pyinotify.WatchManager()
+        wm.add_watch(self.directory, pyinotify.IN_CLOSE_WRITE
+                                     | pyinotify.IN_MOVED_TO)
+        self.notifier = pyinotify.Notifier(wm, Handler(),
+                                           timeout=int(self.poll*1000))
+
+    @property
+    def mode(self):
+        if self.notifier: return 'inotify'
+        return 'polling'
+
+    def changed(self, path):
+        if fnmatch(os.path.basename(path), self.pattern):
+            self.candidates[path] = time()
+
+    def listing(self):
+        '''The (size, mtime) of every matching file in the directory'''
+        stats = dict()
+        for name in os.listdir(self.directory):
+            if not fnmatch(name, self.pattern): continue
+            path = os.path.join(self.directory, name)
+            try: st = os.stat(path)
+            except OSError: continue
+            stats[path] = (st.st_size, st.st_mtime)
+        return stats
+
+    def check(self):
+        '''Wait up to poll seconds for changes and note them'''
+        if self.notifier:
+            if self.notifier.check_events():
+                self.notifier.read_events()
+                self.notifier.process_events()
+            return
+        sleep(self.poll)
+        stats = self.listing()
+        for path, stat in stats.items():
+            if self.seen.get(path) != stat: self.changed(path)
+        self.seen = stats
+
+    def ready(self):
+        '''Move the settled candidates to pending and return its length
+
+        pending is kept oldest first, so peek() and pop() give the newest
+        file. That is the freshest quote, and so the one worth analyzing
+        first when files back up.
+        '''
+        now = time()
+        settled = [path for path, changed in self.candidates.items()
+                   if now - changed >= self.settle]
+        for path in settled:
+            del self.candidates[path]
+            try: self.pending.append((os.path.getmtime(path), path))
+            except OSError: continue
+        if settled: self.pending.sort()
+        return len(self.pending)
+
+    def peek(self):
+        return self.pending[-1][1]
+
+    def pop(self):
+        return self.pending.pop()[1]
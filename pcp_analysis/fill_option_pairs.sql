@@ -0,0 +1,40 @@
+-- Backfill option_pairs from the price tables, for data ingested before the
+-- table existed. New files are paired at ingest.
+INSERT INTO option_pairs
+    (ticker, date, time, expiry, strike, days_to_expiry, stock_bid, stock_ask,
+     call_id, put_id, call_bid, call_ask, put_bid, put_ask)
+    SELECT
+         stock.ticker, 
+         stock.date, 
+         stock.time, 
+         call_contract.expiry,
+         call_contract.strike, 
+         call_contract.expiry - stock.date,
+         stock.bid, 
+         stock.ask, 
+         call_contract.id, 
+         put_contract.id, 
+         call.bid, 
+         call.ask, 
+         put.bid, 
+         put.ask
+    FROM 
+        underlying_prices stock, 
+        option_prices put, 
+        option_prices call, 
+        option_contracts call_contract, 
+        option_contracts put_contract
+    WHERE call_contract.call_put = 'C' 
+        AND put_contract.call_put = 'P'
+        AND call_contract.strike = put_contract.strike 
+        AND call_contract.expiry = put_contract.expiry
+        AND call_contract.ticker = put_contract.ticker
+        AND call_contract.ticker = stock.ticker 
+        AND stock.date = call.date 
+        AND call.date = put.date
+        AND stock.time = call.time 
+        AND call.time = put.time
+        AND call_contract.id = call.id 
+        AND put_contract.id = put.id
+    ON CONFLICT DO NOTHING
+;
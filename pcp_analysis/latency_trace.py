@@ -0,0 +1,99 @@
+#!/usr/bin/python
+from contextlib import contextmanager
+from time import time
+import argparse
+import json
+import os
+import uuid
+
+import numpy as np
+
+TRACEFILE = 'pcp_trace.log'
+PERCENTILES = [50, 95, 99]
+
+class Trace():
+    '''Wall clock timings of one request to the analyzer server
+
+    Every stage's seconds are summed under its name, so a stage run once
+    per trade (send) adds up. Events are seconds since the file landed,
+    taken from its mtime, and are recorded the first time only.
+
+    filename    -- the chain file the request is for
+    received    -- when the server took the request, if it was queued
+    '''
+    def __init__(self, filename, received=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.filename = filename
+        now = time()
+        self.received = received or now
+        try: self.landed = os.path.getmtime(filename)
+        except OSError: self.landed = self.received
+        self.stages = {'wait': self.received - self.landed,
+                       'queue': now - self.received}
+        self.events = dict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time()
+        try: yield
+        finally: self.add(name, time() - start)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def mark(self, event):
+        if event not in self.events:
+            self.events[event] = time() - self.landed
+
+    def write(self, tracefile=TRACEFILE):
+        '''Append the trace to tracefile as one json line
+
+        The line goes out in a single write to a file opened for
+        appending, so traces from concurrent handlers do not interleave.
+        '''
+        self.stages['total'] = time() - self.received
+        record = {'id': self.id, 'pid': os.getpid(),
+                  'filename': self.filename, 'received': self.received,
+                  'stages': self.stages, 'events': self.events}
+        with open(tracefile, 'a') as f: f.write(json.dumps(record) + '\n')
+
+def load_traces(tracefile=TRACEFILE, since=None):
+    traces = []
+    with open(tracefile) as f:
+        for line in f:
+            record = json.loads(line)
+            if since is None or record['received'] >= since:
+                traces.append(record)
+    return traces
+
+def summarize(traces):
+    '''Print p50/p95/p99 and max in ms for every stage and event'''
+    timings = dict()
+    for record in traces:
+        for kind in ['stages', 'events']:
+            for name, seconds in record[kind].items():
+                timings.setdefault((kind, name), []).append(seconds)
+    print '%-8s %-12s %6s' % ('kind', 'name', 'n') + \
+          ''.join([' %9s' % ('p%i ms' % p) for p in PERCENTILES]) + \
+          ' %9s' % 'max ms'
+    for kind, name in sorted(timings):
+        t = np.array(timings[(kind, name)])*1000
+        pcts = [np.percentile(t, p) for p in PERCENTILES]
+        print '%-8s %-12s %6i' % (kind[:-1], name, len(t)) + \
+              ''.join([' %9.1f' % pct for pct in pcts]) + ' %9.1f' % t.max()
+
+if __name__ == '__main__':
+    description = 'Summarize the analyzer server\'s per-stage latencies.'
+
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument('tracefile', type=str, nargs='?', default=TRACEFILE,
+                   help='Default is %s' % TRACEFILE)
+    p.add_argument('--last', type=float,
+                   help='Only the traces received in the last LAST minutes')
+    args = p.parse_args()
+
+    since = None
+    if args.last: since = time() - args.last*60
+    traces = load_traces(args.tracefile, since)
+    print '%i traces' % len(traces)
+    if traces: summarize(traces)
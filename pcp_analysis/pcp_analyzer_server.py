@@ -1,137 +1,324 @@
 #!/usr/bin/python
 from decimal import Decimal
+from multiprocessing import Process, Queue, cpu_count
+from Queue import Full
+from time import time
 import SocketServer
+import argparse
 import logging
 import signal
 import socket
 import sys
 import threading
-from time import sleep
+
+import numpy as np
 
 from finalysis.data_collection import parse_option_chain as poc
+from finalysis.db_registry import ensure_tables, gen_dburl, get_engine
+from finalysis.expiry_calendar import get_calendar
 from finalysis.pcp_analysis import analyze_pcp as apcp
+from finalysis.pcp_analysis.dir_watch import PATTERN, SETTLE, DirWatcher
+from finalysis.pcp_analysis.latency_trace import Trace
+from finalysis.pcp_analysis.result_sink import (BACKUPS, RESULTFILE, 
+                                                gen_record, start_sink)
+from finalysis.pcp_analysis.trade_sender import TradeSender
+
+TRADECASH = -0.04
 
-RESULTFILE = 'pcp_mispricings.txt'
-HFMT = '{date:^10}, {time:^13}, {ticker:^6}, {call_id:^21}, {put_id:^21}, '
-HFMT += '{call:^8}, {strike:^8}, {stock:^8}, {put:^8}, {cash:^9}'
-DFMT = '{date:%Y-%m-%d}, {time:%H:%M:%S%z}, {ticker:^6}, {call_id:^21}, '
-DFMT += '{put_id:^21}, {call:>8.3f}, {strike:>8.3f}, {stock:>8.3f}, '
-DFMT += '{put:>8.3f}, {cash:>8.3f}'
+MODES = ('memory', 'implied')
+TIMEOUT = 5
+STATUS = 'status'
+ACCEPTED = 'accepted'
+BUSY = 'busy'
 
-SENDTRADE = 'Sent %0.3f %s REVERSAL for ticker %s, expiry %s, strike %s'
+SENDTRADE = 'Trace %s: sent %0.3f %s REVERSAL for ticker %s, expiry %s, '
+SENDTRADE += 'strike %s'
 
 parlogger = logging.getLogger(poc.__name__)
 analogger = logging.getLogger('sqlalchemy.dialects.postgresql')
 
 analogger.setLevel(logging.INFO)
 
-def report_ls(result, ticker, call_id, put_id, ls_cash_out):
-    header = HFMT.format(date='DATE', time='TIME', ticker='TICKER', 
-                        call_id='CALL ID', put_id='PUT ID', call='CALL ASK',
-                        strike='STRIKE', stock='STK BID', put='PUT BID',
-                        cash='CASH OUT')
-
-    data = DFMT.format(date=result['stock_date'], time=result['stock_time'],
-                       ticker=ticker, call_id=call_id, put_id=put_id, 
-                       call=result['call_ask'],
-                       strike=result['contract_strike'],
-                       stock=result['stock_bid'], put=result['put_bid'], 
-                       cash=ls_cash_out)
-               
-    with open(RESULTFILE, 'a') as f:
-        f.write(header + "\n")
-        f.write(data + "\n"*3)
-
-def report_sl(result, ticker, call_id, put_id, sl_cash_out):
-    header = HFMT.format(date='DATE', time='TIME', ticker='TICKER', 
-                        call_id='CALL ID', put_id='PUT ID', call='CALL BID',
-                        strike='STRIKE', stock='STK ASK', put='PUT ASK',
-                        cash='CASH OUT')
-
-    data = DFMT.format(date=result['stock_date'], time=result['stock_time'],
-                       ticker=ticker, call_id=call_id, put_id=put_id, 
-                       call=result['call_bid'], 
-                       strike=result['contract_strike'],
-                       stock=result['stock_ask'], put=result['put_ask'], 
-                       cash=sl_cash_out)
-               
-    with open(RESULTFILE, 'a') as f:
-        f.write(header + "\n")
-        f.write(data + "\n"*2)
-
-class ForkedTCPServer(SocketServer.ForkingMixIn, SocketServer.TCPServer):
-    pass
-
-class ForkedTCPRequestHandler(SocketServer.BaseRequestHandler):
-    def handle(self):
-        e_filename = self.request.recv(1024).strip()
-        poc.ChainParser(e_filename, DBNAME, DBHOST)
+# Each worker's connection to the trading server, opened in work(), and
+# the queue to the result writer
+sender = None
+results = None
+
+def trade_message(ticker, call_id, side):
+    expiry = call_id[6:12]
+    strike = str(Decimal(call_id[14:])/1000)
+    message = ','.join([ticker, expiry, strike, '1', side])
+    return message, expiry, strike
+
+def send_trades(ticker, trades, trace):
+    '''Send a snapshot's trades to the trading server in one write
+
+    ticker      -- the underlying's ticker
+    trades      -- (cash_out, side, message, expiry, strike) tuples
+    trace       -- the request's Trace
+    '''
+    try:
+        with trace.stage('send'): 
+            sender.send([trade[2] for trade in trades])
+    except socket.error as err:
+        analogger.error('Trace %s: sending %i trades failed: %s', trace.id,
+                        len(trades), err)
+        return
+    trace.mark('first_trade')
+    for cash_out, side, message, expiry, strike in trades:
+        analogger.info(SENDTRADE, trace.id, cash_out, side.upper(), ticker, 
+                       expiry, strike)
+
+def store(cp, trace):
+    with trace.stage('store'): cp.store()
+
+def analyze(e_filename, trace):
+    '''Parse and store one chain file and act on its mispricings'''
+    p = apcp.PCPAnalyzer(DBNAME, dbhost=DBHOST)
+    with trace.stage('parse'):
+        cp = poc.ChainParser(e_filename, DBNAME, DBHOST, defer_store=True)
+    writer = None
+    if cp.snapshot is not None and MEMORY:
+        writer = threading.Thread(target=store, args=(cp, trace))
+        writer.start()
+        ticker = cp.ticker
+        with trace.stage('query'):
+            cols = p.snapshot_columns(cp.snapshot)
+    else:
+        if cp.snapshot is not None: store(cp, trace)
         filename = e_filename.split('/')[-1]
         ticker, dt = filename.split('.html')[0].split('_')
-        date, time = dt.split('T')
-        p = apcp.PCPAnalyzer(DBNAME, dbhost=DBHOST)
-        results = p.session.execute(p.base_query().\
-            filter(apcp.stock.bid>apcp.call_contract.strike).\
-            filter(apcp.call_contract.expiry-apcp.stock.date<=10).\
-            filter(apcp.stock.ticker==ticker).\
-            filter(apcp.stock.date==date).\
-            filter(apcp.stock.time==time).\
-            filter(apcp.call.bid>0, apcp.put.bid>0).\
-            order_by(apcp.call_contract.id, 
-                    apcp.stock.date, 
-                    apcp.stock.time)).fetchall()
-        for result in results:
-            ls_cash_out, sl_cash_out = p.cash_out_today(result, LEND, BORR)
-            if ls_cash_out < 0 or sl_cash_out < 0:
-                call_id = p.gen_contract_id(result, 'C')
-                put_id = p.gen_contract_id(result, 'P')
-                if ls_cash_out < 0:
-                    report_ls(result, ticker, call_id, put_id, ls_cash_out)
-                if sl_cash_out < 0:
-                    report_sl(result, ticker, call_id, put_id, sl_cash_out)
-                if ls_cash_out < Decimal('-.04'):
-                    expiry = call_id[6:12]
-                    strike = str(Decimal(call_id[14:])/1000)
-                    message = ','.join([ticker, expiry, strike, '1', 'long'])
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.connect((TRADINGHOST, TRADINGPORT))
-                    sock.sendall(message + '\n')
-                    sock.close()
-                    analogger.info(SENDTRADE, ls_cash_out, 'LONG', ticker, 
-                                   expiry, strike)
-                if sl_cash_out < Decimal('-.04'):
-                    expiry = call_id[6:12]
-                    strike = str(Decimal(call_id[14:])/1000)
-                    message = ','.join([ticker, expiry, strike, '1', 'short'])
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.connect((TRADINGHOST, TRADINGPORT))
-                    sock.sendall(message + '\n')
-                    sock.close()
-                    analogger.info(SENDTRADE, ls_cash_out, 'SHORT', ticker, 
-                                   expiry, strike)
-        p.session.close()                    
-        analogger.debug('Closed connection')
+        date, hms = dt.split('T')
+        with trace.stage('query'):
+            rows = p.session.execute(p.pair_query().\
+                filter(apcp.pair.ticker==ticker).\
+                filter(apcp.pair.date==date).\
+                filter(apcp.pair.time==hms).\
+                filter(apcp.pair.call_bid>0, apcp.pair.put_bid>0).\
+                order_by(apcp.pair.call_id, 
+                        apcp.pair.date, 
+                        apcp.pair.time)).fetchall()
+            cols = p.to_columns(rows)
+    if cols is not None:
+        cols = p.select(cols, (cols['call_bid'] > 0) 
+                              & (cols['put_bid'] > 0))
+    if cols is not None and len(cols['contract_strike']):
+        with trace.stage('evaluate'):
+            # The curve uses every strike, so it is built before filtering
+            if IMPLIED:
+                curve = p.implied_curve(cols)
+                r_lend, r_borrow = p.curve_rates(cols, curve, LEND, BORR,
+                                                 BAND)
+            else: r_lend, r_borrow = LEND, BORR
+            cols = p.evaluate_columns(cols, r_lend, r_borrow)
+            candidates = p.candidates(cols)
+            mispriced = candidates & ((cols['ls_cash'] < 0) 
+                                      | (cols['sl_cash'] < 0))
+        # The trades go out in one batch before anything is reported
+        found = []
+        trades = []
+        for i in np.flatnonzero(mispriced):
+            result = p.column_row(cols, i)
+            call_id = p.gen_contract_id(result, 'C')
+            put_id = p.gen_contract_id(result, 'P')
+            found.append((result, call_id, put_id))
+            for cash_out, side in [(result['ls_cash'], 'long'), 
+                                   (result['sl_cash'], 'short')]:
+                if cash_out >= TRADECASH: continue
+                trades.append((cash_out, side) 
+                              + trade_message(ticker, call_id, side))
+        if trades: send_trades(ticker, trades, trace)
+        with trace.stage('report'):
+            records = [gen_record(result, ticker, call_id, put_id, side)
+                       for result, call_id, put_id in found
+                       for side, cash in [('long', 'ls_cash'), 
+                                          ('short', 'sl_cash')]
+                       if result[cash] < 0]
+            if records: results.put(records)
+    if writer: writer.join()
+    p.session.close()                    
+    trace.write()
+    analogger.debug('Trace %s: done', trace.id)
+
+def work(queue, result_queue):
+    '''Analyze the files on the queue until a None is taken off it
+
+    Ctrl-C signals the whole process group, so the worker ignores SIGINT
+    and is stopped by the None the server queues as it shuts down.
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global sender, results
+    results = result_queue
+    sender = TradeSender(TRADINGHOST, TRADINGPORT, ack=ACKS, 
+                         persistent=not ONESHOT)
+    for e_filename, received in iter(queue.get, None):
+        trace = Trace(e_filename, received)
+        analogger.info('Trace %s: started %s', trace.id, e_filename)
+        try: analyze(e_filename, trace)
+        except Exception:
+            analogger.exception('Trace %s: failed %s', trace.id, e_filename)
+    analogger.info('Sent %i trades over %i connections', sender.sent, 
+                   sender.connects)
+    sender.close()
+
+def watch(watcher, queue):
+    '''Queue the files landing in the watched directory, newest first
+
+    Settled files wait in the watcher while the queue is full, so the
+    next one queued is always the newest.
+    '''
+    while True:
+        watcher.check()
+        while watcher.ready():
+            try: queue.put_nowait((watcher.peek(), time()))
+            except Full: break
+            analogger.info('Queued %s', watcher.pop())
+
+class AdmissionServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, queue, queue_size, workers):
+        SocketServer.TCPServer.__init__(self, address, AdmissionHandler)
+        self.queue = queue
+        self.queue_size = queue_size
+        self.workers = workers
+
+class AdmissionHandler(SocketServer.BaseRequestHandler):
+    '''Queue the filename sent and answer accepted, or busy if full
+
+    A client can send status instead of a filename to get the queue
+    depth back.
+    '''
+    def handle(self):
+        self.request.settimeout(TIMEOUT)
+        try: e_filename = self.request.recv(1024).strip()
+        except socket.timeout: return
+        server = self.server
+        if e_filename == STATUS:
+            reply = 'queue %i/%i workers %i' % (server.queue.qsize(), 
+                                                server.queue_size, 
+                                                len(server.workers))
+        else:
+            try: 
+                server.queue.put_nowait((e_filename, time()))
+                reply = ACCEPTED
+            except Full:
+                reply = BUSY
+                analogger.warn('Busy, turned away %s', e_filename)
+        try: self.request.sendall(reply + '\n')
+        except socket.error: pass
 
 if __name__ == '__main__':
-    SERVERHOST = sys.argv[1]
-    SERVERPORT = int(sys.argv[2])
-    TRADINGHOST = sys.argv[3]
-    TRADINGPORT = int(sys.argv[4])
-    DBNAME = sys.argv[5]
-    DBHOST = sys.argv[6]
-    LEND = float(sys.argv[7])
-    BORR = float(sys.argv[8])
+    description = 'Analyze chain files for PCP mispricings as they arrive.'
+
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument('server_host', type=str)
+    p.add_argument('server_port', type=int)
+    p.add_argument('trading_host', type=str)
+    p.add_argument('trading_port', type=int)
+    p.add_argument('db_name', type=str)
+    p.add_argument('db_host', type=str,
+                   help='user:password@host:port, as used by sqlalchemy')
+    p.add_argument('lend_rate', type=float)
+    p.add_argument('borrow_rate', type=float)
+    p.add_argument('modes', type=str, nargs='*',
+                   help='memory analyzes the parsed chain before it is '
+                        'stored, implied prices against the snapshot\'s '
+                        'implied rate curve')
+    p.add_argument('--band', type=float, default=apcp.CURVEBAND,
+                   help='With implied, how far a strike\'s rate must be from '
+                        'the curve to be mispriced. Default is %s' 
+                        % apcp.CURVEBAND)
+    p.add_argument('--workers', type=int, default=cpu_count(),
+                   help='Default is the number of cpus, %i' % cpu_count())
+    p.add_argument('--queue', type=int,
+                   help='Files waiting for a worker before clients are '
+                        'told busy. Default is twice the workers')
+    p.add_argument('--ack', action='store_true',
+                   help='Wait for the trading server to answer every trade '
+                        'with ok')
+    p.add_argument('--oneshot', action='store_true',
+                   help='Connect to the trading server once per snapshot '
+                        'instead of keeping the connection open')
+    p.add_argument('--watch', type=str,
+                   help='Also analyze the chain files written to this '
+                        'directory, without a client sending their names')
+    p.add_argument('--pattern', type=str, default=PATTERN,
+                   help='The files to watch for. Default is %s' % PATTERN)
+    p.add_argument('--settle', type=float, default=SETTLE,
+                   help='Seconds a file must go unchanged before it is '
+                        'analyzed. Default is %s' % SETTLE)
+    p.add_argument('--result_file', type=str, default=RESULTFILE,
+                   help='The csv mispricings are written to. Default is '
+                        '%s' % RESULTFILE)
+    p.add_argument('--result_max_mb', type=float, default=64,
+                   help='Size at which the csv is rotated, keeping %i old '
+                        'files. Default is 64' % BACKUPS)
+    p.add_argument('--result_db', action='store_true',
+                   help='Also write mispricings to the pcp_mispricings table')
+    args = p.parse_args()
+    for mode in args.modes:
+        if mode not in MODES: p.error('unknown mode %s' % mode)
+
+    SERVERHOST = args.server_host
+    SERVERPORT = args.server_port
+    TRADINGHOST = args.trading_host
+    TRADINGPORT = args.trading_port
+    DBNAME = args.db_name
+    DBHOST = args.db_host
+    LEND = args.lend_rate
+    BORR = args.borrow_rate
+    MEMORY = 'memory' in args.modes
+    IMPLIED = 'implied' in args.modes
+    BAND = args.band
+    ACKS = args.ack
+    ONESHOT = args.oneshot
+    queue_size = args.queue or 2*args.workers
     parlogger.info('Starting analyzer server')
     analogger.info('Starting analyzer server')
-    server = ForkedTCPServer((SERVERHOST, SERVERPORT), ForkedTCPRequestHandler)
+
+    # Set up the engine, tables and calendar once for every worker
+    engine = get_engine(gen_dburl(DBNAME, DBHOST))
+    ensure_tables(engine, poc.Base.metadata)
+    get_calendar(engine)
+
+    dburl = None
+    if args.result_db: dburl = gen_dburl(DBNAME, DBHOST)
+    sink, result_queue = start_sink(filename=args.result_file, dburl=dburl,
+                                    max_bytes=int(args.result_max_mb*2**20))
+
+    queue = Queue(queue_size)
+    workers = [Process(target=work, args=(queue, result_queue)) 
+               for i in range(args.workers)]
+    for worker in workers: 
+        worker.daemon = True
+        worker.start()
+
+    if args.watch:
+        watcher = DirWatcher(args.watch, args.pattern, args.settle)
+        watcher_thread = threading.Thread(target=watch, 
+                                          args=(watcher, queue))
+        watcher_thread.daemon = True
+        watcher_thread.start()
+        analogger.info('Watching %s for %s by %s', watcher.directory, 
+                       args.pattern, watcher.mode)
+
+    server = AdmissionServer((SERVERHOST, SERVERPORT), queue, queue_size,
+                             workers)
     parlogger.info('Listening on socket %s:%i', SERVERHOST, SERVERPORT)
     parlogger.info('Sending to socket %s:%i', TRADINGHOST, TRADINGPORT)
     analogger.info('Listening on socket %s:%i', SERVERHOST, SERVERPORT)
     analogger.info('Sending to socket %s:%i', TRADINGHOST, TRADINGPORT)
+    analogger.info('%i workers, queue of %i', len(workers), queue_size)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
-        server.shutdown()
+        server.server_close()
+        for worker in workers: queue.put(None)
+        for worker in workers: worker.join()
+        result_queue.put(None)
+        sink.join()
         parlogger.warn('Analyzer server shutdown')
         analogger.warn('Analyzer server shutdown')
         sys.exit(0)
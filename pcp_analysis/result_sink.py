@@ -0,0 +1,162 @@
+#!/usr/bin/python
+from multiprocessing import Process, Queue
+from Queue import Empty
+from time import time
+import csv
+import logging
+import os
+import signal
+
+from sqlalchemy import Column, Float, Time
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.dialects.postgresql import DATE, NUMERIC, VARCHAR
+
+from finalysis.db_registry import ensure_tables, gen_upsert, get_engine
+
+RESULTFILE = 'pcp_mispricings.csv'
+RESULTCOLS = ['date', 'time', 'ticker', 'side', 'call_id', 'put_id', 'call',
+              'strike', 'stock', 'put', 'cash']
+MAXBYTES = 64*1024*1024
+BACKUPS = 5
+BATCH = 500
+LINGER = 0.25
+
+logger = logging.getLogger('sqlalchemy.dialects.postgresql')
+
+Base = declarative_base()
+
+class Mispricing(Base):
+    '''One side of a call/put pair whose cash out was negative
+
+    side is long for a long-short reversal, priced at the call ask, stock
+    bid and put bid, and short for the short-long one at the call bid,
+    stock ask and put ask.
+    '''
+    __tablename__ = 'pcp_mispricings'
+    ticker = Column(VARCHAR(6), primary_key=True)
+    date = Column(DATE, primary_key=True)
+    time = Column(Time(timezone=True), primary_key=True)
+    call_id = Column(VARCHAR(21), primary_key=True)
+    side = Column(VARCHAR(5), primary_key=True)
+    put_id = Column(VARCHAR(21))
+    call = Column(NUMERIC(8,3))
+    strike = Column(NUMERIC(8,3))
+    stock = Column(NUMERIC(8,3))
+    put = Column(NUMERIC(8,3))
+    cash = Column(Float)
+
+def gen_record(result, ticker, call_id, put_id, side):
+    '''A mispricing record from a column_row result
+
+    side        -- long or short
+    '''
+    if side == 'long': call, stock, put = 'call_ask', 'stock_bid', 'put_bid'
+    else: call, stock, put = 'call_bid', 'stock_ask', 'put_ask'
+    cash = {'long': 'ls_cash', 'short': 'sl_cash'}[side]
+    return {'date': result['stock_date'], 'time': result['stock_time'],
+            'ticker': ticker, 'side': side, 'call_id': call_id,
+            'put_id': put_id, 'call': float(result[call]),
+            'strike': float(result['contract_strike']),
+            'stock': float(result[stock]), 'put': float(result[put]),
+            'cash': float(result[cash])}
+
+class ResultSink():
+    '''Batches mispricing records to a rotating csv and optionally a table
+
+    Records are written when BATCH of them are waiting or the oldest has
+    waited LINGER seconds, whichever comes first. The csv is rotated once
+    it passes max_bytes, keeping backups old files as filename.1, .2, ...
+
+    filename    -- the csv to append to
+    max_bytes   -- the size at which the csv is rotated
+    backups     -- the number of rotated files to keep
+    dburl       -- also write the records to pcp_mispricings in this db
+    batch       -- the most records per write
+    linger      -- the longest a record waits to be written, in seconds
+    '''
+    def __init__(self, filename=RESULTFILE, max_bytes=MAXBYTES,
+                 backups=BACKUPS, dburl=None, batch=BATCH, linger=LINGER):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch = batch
+        self.linger = linger
+        self.written = 0
+        self.flushes = 0
+        self.engine = None
+        if dburl:
+            self.engine = get_engine(dburl)
+            ensure_tables(self.engine, Base.metadata)
+            self.stmt = gen_upsert(self.engine, Mispricing.__table__,
+                                   update=False)
+        self.open()
+
+    def open(self):
+        self.f = open(self.filename, 'ab')
+        self.writer = csv.DictWriter(self.f, RESULTCOLS)
+        if not self.f.tell(): self.writer.writeheader()
+
+    def rotate(self):
+        self.f.close()
+        for i in range(self.backups - 1, 0, -1):
+            older = '%s.%i' % (self.filename, i)
+            if os.path.exists(older):
+                os.rename(older, '%s.%i' % (self.filename, i + 1))
+        if self.backups: os.rename(self.filename, '%s.1' % self.filename)
+        else: os.remove(self.filename)
+        self.open()
+
+    def flush(self, records):
+        if not records: return
+        self.writer.writerows(records)
+        self.f.flush()
+        if self.f.tell() >= self.max_bytes: self.rotate()
+        if self.engine is not None:
+            try: self.engine.execute(self.stmt, records)
+            except Exception as err:
+                logger.error('Storing %i mispricings failed: %s'
+                             % (len(records), err))
+        self.written += len(records)
+        self.flushes += 1
+
+    def run(self, queue):
+        '''Write the record lists put on queue until a None is taken off'''
+        pending = []
+        deadline = None
+        done = False
+        while not done:
+            timeout = None
+            if deadline is not None: timeout = max(deadline - time(), 0)
+            try: records = queue.get(timeout=timeout)
+            except Empty: records = []
+            if records is None: done = True
+            elif records:
+                if not pending: deadline = time() + self.linger
+                pending.extend(records)
+            if done or len(pending) >= self.batch or \
+               (deadline is not None and time() >= deadline):
+                self.flush(pending)
+                pending = []
+                deadline = None
+        self.f.close()
+        logger.info('Wrote %i mispricings in %i flushes'
+                    % (self.written, self.flushes))
+
+def run_sink(queue, kwargs):
+    # Ctrl-C signals the whole process group. The writer ignores it and
+    # stops at the None put on the queue once the workers are done.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ResultSink(**kwargs).run(queue)
+
+def start_sink(**kwargs):
+    '''Start a writer process and return it with the queue it reads
+
+    Analysis code puts lists of records on the queue, which is unbounded
+    so a put never waits on the disk or the db. Putting None stops the
+    writer once everything before it is written.
+    '''
+    queue = Queue()
+    writer = Process(target=run_sink, args=(queue, kwargs))
+    writer.daemon = True
+    writer.start()
+    return writer, queue
@@ -0,0 +1,34 @@
+#!/usr/bin/python
+import SocketServer
+import argparse
+import sys
+
+from finalysis.pcp_analysis.trade_sender import ACK
+
+class StandinServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class StandinHandler(SocketServer.StreamRequestHandler):
+    '''Write every trade line received to stdout, acking it if asked'''
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            sys.stdout.write(line)
+            sys.stdout.flush()
+            if self.server.ack: self.wfile.write(ACK + '\n')
+
+if __name__ == '__main__':
+    description = 'Stand in for the reversal trading server, printing the '
+    description += 'trades it is sent.'
+
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument('host', type=str)
+    p.add_argument('port', type=int)
+    p.add_argument('--ack', action='store_true',
+                   help='Answer every trade with %s' % ACK)
+    args = p.parse_args()
+
+    server = StandinServer((args.host, args.port), StandinHandler)
+    server.ack = args.ack
+    try: server.serve_forever()
+    except KeyboardInterrupt: server.server_close()
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+import logging
+import select
+import socket
+
+TIMEOUT = 5
+ACK = 'ok'
+
+logger = logging.getLogger('sqlalchemy.dialects.postgresql')
+
+class TradeRejected(socket.error):
+    pass
+
+class TradeSender():
+    '''A long-lived connection to the reversal trading server
+
+    Trades are newline terminated lines. A batch of them goes out in one
+    write. The connection is opened on the first send and kept for every
+    send after it, and reopened if the server has closed it.
+
+    Without acks there is no telling how much of a failed write reached
+    the server, so the batch is not sent again and the error says it may
+    have been partly delivered. A write into a connection the server has
+    just reset can also succeed and lose the trades, so use acks where
+    that matters. With acks, the trades not yet acknowledged when the
+    connection fails are sent once more on a new connection.
+
+    host        -- the trading server's host
+    port        -- the trading server's port
+    ack         -- wait for the server to answer every line with 'ok'
+    persistent  -- keep the connection open between batches
+    timeout     -- seconds to wait on connect, send and acks
+    '''
+    def __init__(self, host, port, ack=False, persistent=True,
+                 timeout=TIMEOUT):
+        self.address = (host, port)
+        self.ack = ack
+        self.persistent = persistent
+        self.timeout = timeout
+        self.sock = None
+        self.connects = 0
+        self.sent = 0
+
+    def connect(self):
+        self.close()
+        self.sock = socket.create_connection(self.address, self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connects += 1
+
+    def close(self):
+        if self.sock is None: return
+        try: self.sock.close()
+        except socket.error: pass
+        self.sock = None
+
+    def stale(self):
+        '''True if the server closed the connection since the last send
+
+        An idle connection should have nothing to read, so anything
+        readable is either the close or stray data, and either way the
+        connection is not worth keeping.
+        '''
+        if self.sock is None: return True
+        readable = select.select([self.sock], [], [], 0)[0]
+        return bool(readable)
+
+    def send(self, messages):
+        '''Send a batch of trade messages in one write
+
+        messages    -- a list of lines, without their newlines
+        '''
+        if not messages: return
+        if self.stale(): self.connect()
+        if not self.ack:
+            try: self.sock.sendall(''.join([m + '\n' for m in messages]))
+            except socket.error as err:
+                self.close()
+                raise socket.error('%s, the batch of %i trades may have '
+                                   'been partly delivered'
+                                   % (err, len(messages)))
+        else:
+            acked = self.send_acked(messages)
+            if acked < len(messages):
+                logger.warn('Resending the %i of %i trades not acknowledged, '
+                            'which repeats any the server took without '
+                            'acking' % (len(messages) - acked, len(messages)))
+                self.connect()
+                rest = len(messages) - acked
+                if self.send_acked(messages[acked:]) < rest:
+                    self.close()
+                    raise socket.error('%i of %i trades were not '
+                                       'acknowledged' % (rest, len(messages)))
+        self.sent += len(messages)
+        if not self.persistent: self.close()
+
+    def send_acked(self, messages):
+        '''Write messages and return how many were acknowledged before the
+        connection failed'''
+        self.reply = ''
+        try:
+            self.sock.sendall(''.join([m + '\n' for m in messages]))
+            self.wait_acks(len(messages))
+        except TradeRejected:
+            raise
+        except socket.error as err:
+            logger.warn('Trade connection failed: %s' % err)
+        return min(self.reply.count('\n'), len(messages))
+
+    def wait_acks(self, count):
+        while self.reply.count('\n') < count:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise socket.error('Connection closed with %i of %i acks'
+                                   % (self.reply.count('\n'), count))
+            self.reply += chunk
+        lines = self.reply.split('\n')[:count]
+        bad = [line for line in lines if line.strip() != ACK]
+        if bad: raise TradeRejected('Trade rejected: %s' % bad[0])
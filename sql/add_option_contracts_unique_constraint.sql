@@ -0,0 +1,50 @@
+-- Concurrent parsers may already have created the same contract more than
+-- once. Keep the lowest id of each (ticker, expiry, call_put, strike), move
+-- the prices of the others onto it, and only then add the constraint.
+BEGIN;
+
+LOCK TABLE option_contracts IN EXCLUSIVE MODE;
+
+CREATE TEMP TABLE option_contracts_dupes ON COMMIT DROP AS
+    SELECT id, keep
+      FROM (SELECT id, min(id) OVER (PARTITION BY ticker, expiry, call_put,
+                                                  strike) AS keep
+              FROM option_contracts) c
+     WHERE id <> keep;
+
+-- A snapshot stored under more than one copy keeps a single price row,
+-- the surviving contract's if it has one
+WITH ranked AS (
+    SELECT p.id, p.date, p.time,
+           row_number() OVER (PARTITION BY g.keep, p.date, p.time
+                              ORDER BY p.id) AS n
+      FROM option_prices p
+      JOIN (SELECT id, keep FROM option_contracts_dupes
+            UNION SELECT keep, keep FROM option_contracts_dupes) g
+        ON g.id = p.id)
+DELETE FROM option_prices p
+      USING ranked r
+      WHERE r.n > 1 AND p.id = r.id AND p.date = r.date AND p.time = r.time;
+
+UPDATE option_prices p SET id = d.keep
+  FROM option_contracts_dupes d
+ WHERE p.id = d.id;
+
+DO $$
+BEGIN
+    IF to_regclass('option_pairs') IS NOT NULL THEN
+        UPDATE option_pairs p SET call_id = d.keep
+          FROM option_contracts_dupes d WHERE p.call_id = d.id;
+        UPDATE option_pairs p SET put_id = d.keep
+          FROM option_contracts_dupes d WHERE p.put_id = d.id;
+    END IF;
+END $$;
+
+DELETE FROM option_contracts c
+      USING option_contracts_dupes d
+      WHERE c.id = d.id;
+
+ALTER TABLE option_contracts ADD CONSTRAINT option_contracts_contract_key
+                                 UNIQUE (ticker, expiry, call_put, strike);
+
+COMMIT;
@@ -2,33 +2,28 @@
 from datetime import datetime, timedelta
 import argparse
 
-
-from sqlalchemy import create_engine, MetaData
-
-from finalysis.holidays_orm import gen_table
-
-#def last_trading_day(date, table, results):
-def last_trading_day(date, table, results=[], verbose=False):
-    whereclause = "date = '%s'" % date.isoformat()
-    r = table.select(whereclause=whereclause).execute()
-    if date.weekday() >= 5:
-        msg = 'Not a trading day:'
-        result = (msg, date.strftime('%A'), date.isoformat())
-        results += [result]
-        last_trading_day(date - timedelta(days=1), table, results, verbose)
-#        last_trading_day(date - timedelta(days=1), table)
-    elif r.rowcount >= 1:
-        row = dict(zip(r.keys(), r.fetchone()))
-        msg = 'Not a trading day:'
-        result = (msg, row['holiday'], row['date'].isoformat())
-        results += [result]
-        last_trading_day(date - timedelta(days=1), table, results, verbose)
-#        last_trading_day(date - timedelta(days=1), table)
-    else:
-        msg = 'Most recent trading day:'
-        result = (msg, date.strftime('%A'), date.isoformat())
-        results += [result]
-    if verbose: print '%s %s, %s' % result
+from sqlalchemy import create_engine
+
+from finalysis.expiry_calendar import get_calendar
+
+def last_trading_day(date, calendar, results=None, verbose=False):
+    '''Walk back from date to the most recent trading day
+
+    Returns a list of (message, day or holiday name, date) for every day
+    passed over and then the trading day, read from an ExpiryCalendar so
+    the holidays come from the db only once.
+    '''
+    if results is None: results = []
+    msg = 'Not a trading day:'
+    while not calendar.is_trading_day(date):
+        if date.weekday() >= 5: name = date.strftime('%A')
+        else: name = calendar.holidays[date]
+        results += [(msg, name, date.isoformat())]
+        if verbose: print '%s %s, %s' % results[-1]
+        date -= timedelta(days=1)
+    msg = 'Most recent trading day:'
+    results += [(msg, date.strftime('%A'), date.isoformat())]
+    if verbose: print '%s %s, %s' % results[-1]
     return results
 
 if __name__ == '__main__':
@@ -57,9 +52,8 @@ if __name__ == '__main__':
                                                 args.port, 
                                                 args.db_name)
     engine = create_engine(dburl)
-    metadata = MetaData(bind=engine)
-    table = gen_table(args.tablename, metadata, args.schema)
+    calendar = get_calendar(engine, args.tablename, args.schema)
     if args.fromdate: date = datetime.strptime(args.fromdate, '%Y-%m-%d').date()
     else: date = datetime.now().date()
 
-    results = last_trading_day(date, table, verbose=True)
+    results = last_trading_day(date, calendar, verbose=True)